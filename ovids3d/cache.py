@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ovids3d', 'cache')
+CACHE_VERSION = 6
+
+#########################################################
+##### class MapCache ####################################
+#########################################################
+
+class MapCache(object):
+    """On-disk cache of preprocessed maps.
+
+    Each entry is a .npy file (loaded memory-mapped) and a
+    small json file for its metadata. Entries are keyed by the content
+    hash of the input file and the display parameters. The least
+    recently used entries are removed when the cache grows over
+    maxsize.
+    """
+
+    def __init__(self, path=None, maxsize=20):
+        """
+        :param path: cache directory (default ~/.ovids3d/cache)
+
+        :param maxsize: maximum size of the cache in GB
+        """
+        if path is None:
+            path = CACHE_DIR
+        self.path = path
+        self.maxsize = maxsize * 1024**3
+        # one small json file per hashed input file, so that several
+        # processes can update them without a lock
+        self.hashes_path = os.path.join(self.path, 'hashes')
+        os.makedirs(self.hashes_path, exist_ok=True)
+
+    def _get_entry_path(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def get_file_hash(self, path):
+        """Return the content hash of a file. Hashes are remembered as
+        long as the size and modification time of the file do not
+        change.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        hash_path = os.path.join(self.hashes_path, hashlib.blake2b(
+            path.encode(), digest_size=20).hexdigest() + '.json')
+        try:
+            with open(hash_path) as f:
+                entry = json.load(f)
+            if entry['path'] == path and entry['stamp'] == stamp:
+                return entry['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        logger.info('computing hash of {}'.format(path))
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                h.update(block)
+        self._write_json(hash_path, dict(path=path, stamp=stamp, hash=h.hexdigest()))
+        return h.hexdigest()
+
+    def get_key(self, path, **params):
+        """Return the cache key of a file (or a list of files) processed
+        with the given parameters.
+        """
+        params = {k: (getattr(v, 'name', v) if k == 'cmap' else v) for k, v in params.items()}
+        params['version'] = CACHE_VERSION
+        if isinstance(path, str):
+            params['hash'] = self.get_file_hash(path)
+        else:
+            params['hash'] = [self.get_file_hash(ipath) for ipath in path]
+        return hashlib.blake2b(
+            repr(sorted(params.items())).encode(), digest_size=20).hexdigest()
+
+    def load(self, key):
+        """Return (array, metadata) or None if the entry does not exist.
+        The array is memory-mapped in read-only mode.
+        """
+        npy_path = self._get_entry_path(key, '.npy')
+        json_path = self._get_entry_path(key, '.json')
+        if not (os.path.exists(npy_path) and os.path.exists(json_path)):
+            return None
+        try:
+            with open(json_path) as f:
+                meta = json.load(f)
+            arr = np.load(npy_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logger.warning('corrupted cache entry {}: {}'.format(key, e))
+            return None
+
+        os.utime(npy_path) # last access time for LRU eviction
+        logger.info('map loaded from cache ({})'.format(npy_path))
+        return arr, meta
+
+    def save(self, key, arr, **meta):
+        """Save an array and its metadata.
+        """
+        npy_path = self._get_entry_path(key, '.npy')
+        # the same entry can be written by several processes
+        tmp_path = self._get_entry_path(key, '.{}.tmp.npy'.format(os.getpid()))
+        np.save(tmp_path, arr)
+        os.replace(tmp_path, npy_path)
+        self._write_json(self._get_entry_path(key, '.json'), meta)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache is
+        smaller than maxsize.
+
+        :param keep: key of an entry which is never removed (e.g. the
+          entry just saved)
+        """
+        entries = list()
+        for ifile in os.listdir(self.path):
+            if ifile.endswith('.npy') and not ifile.endswith('.tmp.npy'):
+                ikey = ifile[:-4]
+                try: # the entry can be removed by another process
+                    stat = os.stat(self._get_entry_path(ikey, '.npy'))
+                    isize = stat.st_size
+                    if os.path.exists(self._get_entry_path(ikey, '.json')):
+                        isize += os.path.getsize(self._get_entry_path(ikey, '.json'))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, isize, ikey))
+
+        total = sum([ientry[1] for ientry in entries])
+        for _, isize, ikey in sorted(entries):
+            if total <= self.maxsize: break
+            if ikey == keep: continue
+            logger.info('removing cache entry {}'.format(ikey))
+            for ext in ('.npy', '.json'):
+                try:
+                    os.remove(self._get_entry_path(ikey, ext))
+                except OSError: pass
+            total -= isize
+
+    def clear(self):
+        """Remove all the entries.
+        """
+        maxsize = self.maxsize
+        self.maxsize = 0
+        self.evict()
+        self.maxsize = maxsize
+
+    def _write_json(self, path, obj):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+
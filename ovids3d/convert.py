@@ -0,0 +1,102 @@
+import os
+import glob
+import multiprocessing
+import concurrent.futures
+
+from . import core
+from . import models
+from . import readers
+
+import logging
+logger = logging.getLogger(__name__)
+
+#########################################################
+##### map conversion ####################################
+#########################################################
+
+def convert_map(path, cmap, outpath=None, leafsize=100000, seed=0, **kwargs):
+    """Convert a map into render-ready assets (see
+    models.write_map_asset). No window is needed.
+
+    :param path: path to a map (see core.Map3d)
+
+    :param cmap: name of the colormap
+
+    :param outpath: path to the output directory (default is path
+      with its extension, e.g. .fits or .fits.gz, replaced by
+      models.ASSET_EXT)
+
+    :param leafsize: maximum number of points in a chunk
+
+    :param seed: seed of the subsampling and of the sampling of the
+      chunks
+
+    :param kwargs: other parameters of core.Map3d (e.g. perc,
+      colorpower, limitnb)
+
+    :return: the path to the output directory
+    """
+    if outpath is None:
+        outpath = strip_ext(path)
+    map3d = core.Map3d(path, cmap, compact=True, seed=seed, **kwargs)
+    return models.write_map_asset(outpath, map3d, leafsize=leafsize, seed=seed)
+
+def strip_ext(path):
+    """Return a path without its extension. A compression suffix
+    (e.g. map.fits.gz or map.fits.fz) is removed with the extension of
+    the map.
+    """
+    root, ext = os.path.splitext(path)
+    if ext.lower() in ('.gz', '.fz', '.bz2'):
+        iroot, iext = os.path.splitext(root)
+        if iext.lower() in readers.READERS:
+            root = iroot
+    return root
+
+def get_map_paths(paths):
+    """Return the list of the maps (the files with a known reader, see
+    readers.get_reader) given by a list of files and directories.
+    """
+    map_paths = list()
+    for path in paths:
+        if os.path.isdir(path):
+            map_paths += sorted([ipath for ipath in glob.glob(os.path.join(path, '*'))
+                                 if readers.get_reader_class(ipath) is not None])
+        else:
+            map_paths.append(path)
+    return map_paths
+
+def convert_maps(paths, cmap, outdir=None, processes=None, **kwargs):
+    """Convert a list of maps in parallel in a pool of processes (see
+    convert_map).
+
+    :param paths: list of maps or directories of maps
+
+    :param outdir: output directory (default is the directory of each
+      map)
+
+    :param processes: number of worker processes (default is the
+      number of cpus)
+
+    :param kwargs: other parameters of convert_map
+
+    :return: the list of the output directories
+    """
+    paths = get_map_paths(paths)
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+
+    # spawned processes do not inherit the threads of the parent process
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context) as executor:
+        futures = list()
+        for path in paths:
+            outpath = None
+            if outdir is not None:
+                outpath = os.path.join(outdir, strip_ext(os.path.basename(path)))
+            futures.append(executor.submit(convert_map, path, cmap, outpath=outpath,
+                                           **kwargs))
+        for future in concurrent.futures.as_completed(futures):
+            logger.info('{} written'.format(future.result()))
+
+    return [future.result() for future in futures]
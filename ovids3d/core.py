@@ -2,20 +2,20 @@ import warnings
 import sys
 import os
 import numpy as np
-import scipy.interpolate
-import astropy.io.fits as pyfits
-import pylab as pl
-import matplotlib.cm
-import matplotlib.colors
-import xml.etree.ElementTree
+import multiprocessing
+import concurrent.futures
 
 from panda3d.core import Vec4, Vec3, VBase4, WindowProperties
 from direct.showbase.DirectObject import DirectObject
+from direct.task.Task import Task
 
 ROOT = os.path.join(os.path.split(__file__)[0])
 CMAP_PATH = '.cmap.png'
 
 import ovids3d.ext.cbar
+from . import utils
+from . import cache
+from . import readers
 
 import logging
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -45,8 +45,15 @@ class Config(SpecialDict):
         self['spacescale'] = 1 # m / 3d space unit
         self['timescale'] = 1 # s / real s
         self['movescale'] = 2 # s / real s
+        self['damping'] = 4 # 1 / s, inertia of the keyboard flight (must be > 0)
         self['debug'] = False
         self['fps'] = 30
+        self['offscreen'] = False # offscreen rendering with a fixed timestep of 1/fps (see World)
+        self['cache'] = True # preprocessed maps cache
+        self['cache_dir'] = None # default is ~/.ovids3d/cache
+        self['cache_size'] = 20 # GB
+        self['cbar_png'] = False # matplotlib colorbar instead of a gradient texture
+        self['hud_rate'] = 5 # Hz, refresh rate of the numbers of the overlay
         
 
     def get(self, key, default):
@@ -114,100 +121,584 @@ class Colors(object):
         if alpha is not None:
             alpha = np.clip(alpha, 0, 1)
 
+        import matplotlib.colors
         color = Vec4(matplotlib.colors.to_rgba(color, alpha=alpha))
         logger.info('output color:{}'.format(color))
                         
         return color
 
+#########################################################
+##### class Quantiles ###################################
+#########################################################
+
+class Quantiles(object):
+    """Approximate quantiles of a stream of chunks.
+
+    The finite values are binned on the upper nbits bits of their
+    float32 representation (mapped onto sortable unsigned integers) so
+    that no prior knowledge of their range is needed and the memory
+    stays constant (2**nbits counters). A returned value is the lower
+    edge of the bin containing the value of requested rank: its
+    relative error is smaller than 2**-(nbits - 9).
+    """
+    
+    def __init__(self, nbits=20):
+        self.shift = np.uint32(32 - nbits)
+        self.hist = np.zeros(2**nbits, dtype=np.int64)
+        self.count = 0
+
+    @staticmethod
+    def to_keys(a):
+        """Map float32 values onto uint32 keys with the same ordering.
+        """
+        a = np.atleast_1d(np.asarray(a, dtype=np.float32)).view(np.uint32)
+        neg = a >= np.uint32(0x80000000)
+        keys = a ^ np.uint32(0x80000000)
+        keys[neg] = ~a[neg]
+        return keys
+
+    @staticmethod
+    def from_keys(keys):
+        """Inverse of to_keys.
+        """
+        keys = np.atleast_1d(np.asarray(keys, dtype=np.uint32))
+        pos = keys >= np.uint32(0x80000000)
+        a = ~keys
+        a[pos] = keys[pos] ^ np.uint32(0x80000000)
+        return a.view(np.float32)
+
+    def update(self, chunk):
+        """Add a chunk of values. Non-finite values are ignored.
+        """
+        chunk = np.asarray(chunk, dtype=np.float32).ravel()
+        chunk = chunk[np.isfinite(chunk)]
+        self.hist += np.bincount(self.to_keys(chunk) >> self.shift,
+                                 minlength=self.hist.size)
+        self.count += chunk.size
+
+    def get(self, perc):
+        """Return the float32 values at the given percentiles (0-100).
+        """
+        if self.count == 0: raise Exception('no finite value')
+        ranks = np.floor((self.count - 1) * np.asarray(perc, dtype=float) / 100.)
+        bins = np.searchsorted(np.cumsum(self.hist), ranks, side='right')
+        return self.from_keys(bins.astype(np.uint32) << self.shift)
+
+    def count_from(self, value):
+        """Return the number of values greater or equal to a value
+        returned by get().
+        """
+        return int(np.sum(self.hist[int(self.to_keys(value)[0] >> self.shift):]))
+    
+#########################################################
+##### class Subsampler ##################################
+#########################################################
+
+class Subsampler(object):
+    """Seeded streaming subsampler. Chunks of points are given in a
+    fixed order and the nb points of lowest priority are kept. The
+    priorities are drawn from a random generator seeded with seed so
+    that the same points always give the same subset (whatever the
+    chunk size).
+
+    Modes:
+
+    - 'uniform': uniform sampling without replacement.
+
+    - 'flux': sampling without replacement weighted by the flux
+      (priority -log(u)/w, Efraimidis and Spirakis): bright structures
+      are kept, noise is thinned.
+
+    - 'voxel': the points are binned on a grid of 2**(3*voxelbits)
+      voxels and every voxel keeps its points up to the same number
+      (priority u * count of the voxel): dense regions are thinned,
+      sparse ones are kept. The voxels counts must be computed first
+      (see add_voxels).
+    """
+
+    MODES = ('uniform', 'flux', 'voxel')
+    
+    def __init__(self, nb, mode='flux', seed=0, voxelbits=6):
+        if mode not in self.MODES:
+            raise Exception('mode must be in {}'.format(self.MODES))
+        self.nb = int(nb)
+        self.mode = mode
+        self.voxelbits = voxelbits
+        self.rng = np.random.default_rng(seed)
+        self.voxel_counts = np.zeros(2**(3 * voxelbits), dtype=np.int64)
+        self.priorities = np.empty(0, dtype=np.float64)
+        self.index = np.empty(0, dtype=np.int64)
+        self.count = 0
+
+    def add_voxels(self, voxels):
+        """Count the points in each voxel (first pass of the 'voxel'
+        mode).
+
+        :param voxels: voxel indexes of a chunk of points
+        """
+        self.voxel_counts += np.bincount(voxels, minlength=self.voxel_counts.size)
+        
+    def update(self, weights=None, voxels=None):
+        """Add a chunk of points.
+
+        :param weights: weights of the points ('flux' mode), e.g. their
+          normalized flux. Negative and non-finite weights are set to
+          0 and faint points keep a small chance to be kept.
+
+        :param voxels: voxel indexes of the points ('voxel' mode)
+        """
+        size = np.size(weights if weights is not None else voxels)
+        u = self.rng.random(size)
+        if self.mode == 'uniform':
+            priorities = u
+        elif self.mode == 'flux':
+            weights = np.clip(np.nan_to_num(np.asarray(weights, dtype=np.float64)), 0, None)
+            priorities = -np.log1p(-u) / (weights + 1e-6)
+        else:
+            priorities = u * self.voxel_counts[voxels]
+            
+        self.priorities = np.concatenate((self.priorities, priorities))
+        self.index = np.concatenate((
+            self.index, np.arange(self.count, self.count + size, dtype=np.int64)))
+        self.count += size
+        if self.index.size > self.nb:
+            keep = np.argpartition(self.priorities, self.nb - 1)[:self.nb]
+            self.priorities = self.priorities[keep]
+            self.index = self.index[keep]
+
+    def get(self):
+        """Return the sorted indexes of the kept points.
+        """
+        return np.sort(self.index)
+    
+#########################################################
+##### class ColorLUT ####################################
+#########################################################
+
+class ColorLUT(object):
+    """Colormap lookup table with colorpower and colorscale already
+    applied. Normalized flux values (between 0 and 1, before
+    colorpower) are mapped to colors by integer indexing.
+    """
+    
+    def __init__(self, cmap, colorpower=1, colorscale=(1,1,1,1), size=4096):
+        if isinstance(cmap, str):
+            import matplotlib.cm
+            cmap = getattr(matplotlib.cm, cmap)
+        self.cmap = cmap
+        self.size = size
+        self.colorpower = colorpower
+        
+        rgba = cmap(np.linspace(0, 1, size) ** colorpower)
+        rgba[:,3] = 1
+        rgba *= np.array(colorscale)
+        self.rgba = rgba.astype(np.float32)
+        # converted as Panda3D does
+        self.rgba8 = np.clip(rgba * 255, 0, 255).astype(np.uint8)
+
+    def get_index(self, values):
+        """Return the LUT indexes of normalized values. NaNs get the
+        index of 0.
+        """
+        index = np.clip(np.nan_to_num(values, nan=0.), 0, 1) * (self.size - 1) + 0.5
+        return index.astype(np.intp)
+        
+    def __call__(self, values, compact=False):
+        """Return the (N, 4) colors of normalized values, as uint8 if
+        compact, else as float32.
+        """
+        if compact:
+            return self.rgba8[self.get_index(values)]
+        return self.rgba[self.get_index(values)]
+        
 #########################################################
 ##### class Map3d #######################################
 #########################################################
 
 class Map3d(object):
 
-    def __init__(self, path, cmap, flux_unit='flux', scale=1, colorpower=1, colorscale=(1,1,1,1), perc=(3,99), limitnb=None):
+    EXACT_PERC_MAXSIZE = 10000000
+
+    def __init__(self, path, cmap, flux_unit='flux', scale=1, colorpower=1, colorscale=(1,1,1,1),
+                 perc=(3,99), limitnb=None, memmap=False, chunksize=1000000, cache=None,
+                 percmode='auto', compact=False, scalar=False, sampling='flux', seed=0,
+                 keepnan=False, progress=None, columns=None):
+        """
+        :param path: path to a FITS file containing an (N, 4) or (4, N)
+          array of (X, Y, Z, F) values, to a table (FITS binary table,
+          .npy, .npz, HDF5 or Parquet file, see readers.get_reader), or
+          a readers.Reader instance (e.g. readers.MapsReader, see also
+          from_maps).
+
+        :param columns: names of the x, y, z and flux columns of a
+          table. Only these columns are read.
+
+        :param memmap: if True, the FITS HDU is memory-mapped and only
+          read chunk by chunk so that the whole (N, 4) array is never
+          loaded (nor copied) in memory. Use it for catalogs close to
+          the available RAM.
+
+        :param chunksize: number of points processed at once. All the
+          computations are done in float32.
+
+        :param cache: a cache.MapCache instance. If not None, the
+          processed map is loaded from the cache when the file and the
+          parameters have not changed (and saved into it otherwise).
+
+        :param percmode: 'exact' computes the flux limits from the
+          whole flux column held in memory. 'approx' computes them in
+          the same chunked pass with constant memory (see Quantiles for
+          the error bound). 'auto' is 'exact' for maps smaller than
+          EXACT_PERC_MAXSIZE points.
+
+        :param compact: if True, colors are stored as uint8 RGBA (as
+          they are stored on the GPU) instead of float32: 20 bytes per
+          point instead of 32.
+
+        :param scalar: if True, colors are not computed and all the
+          points with a finite flux are kept: c holds the raw flux and
+          the colormap is meant to be applied on the GPU (see
+          models.ScalarPixels). The flux histogram is kept in
+          self.quantiles to recompute flux limits at no cost.
 
+        :param keepnan: if True (scalar mode only), the points with a
+          non-finite flux are also kept, so that the positions only
+          depend on the input positions (and limitnb) and can be
+          shared by different maps (see models.LayerPixels). The
+          points with a non-finite position are always dropped.
+
+        :param progress: if not None, a function called as
+          progress(step, fraction) while the map is processed (e.g. to
+          display the progress of a map loaded in the background).
+
+        :param limitnb: if not None, maximum number of points kept.
+
+        :param sampling: subsampling mode used with limitnb: 'uniform',
+          'flux' or 'voxel' (see Subsampler).
+
+        :param seed: seed of the subsampling. The same inputs always
+          give the same subset.
+        """
         assert len(perc) == 2, 'perc must be 2-tuple (percmin, percmax) not {}'.format(perc)
+        if sampling not in Subsampler.MODES:
+            raise Exception('sampling must be in {}'.format(Subsampler.MODES))
+
+        utils.reset_peak_memory()
+        self.cmap = cmap
+        self.flux_unit = flux_unit
+        self.scale = scale
+        self.colorpower = colorpower
+        self.colorscale = tuple(colorscale)
+        self.perc = tuple(perc)
+        self.limitnb = limitnb
+        self.sampling = sampling
+        self.seed = seed
+        self.percmode = percmode
+        self.compact = compact
+        self.scalar = scalar
+        self.keepnan = keepnan
+        self.progress = progress
+        if keepnan and not scalar: raise Exception('keepnan can only be used in scalar mode')
+        
+        if isinstance(path, readers.Reader):
+            reader = path
+        else:
+            reader = readers.get_reader(path, columns=columns, memmap=memmap)
         
-        def pixelsort(x, y, z, r, g, b, a, c):
-            _s = np.argsort(z)
-            _s2 = np.argsort(y[_s])
-            _s3 = np.argsort(x[_s][_s2])
-            return (x[_s][_s2][_s3], y[_s][_s2][_s3], z[_s][_s2][_s3],
-                    r[_s][_s2][_s3], g[_s][_s2][_s3], b[_s][_s2][_s3], a[_s][_s2][_s3],
-                    c[_s][_s2][_s3])
+        cached = None
+        if cache is not None and len(reader.paths) > 0:
+            key = cache.get_key(reader.paths, reader=reader.params, cmap=cmap, perc=self.perc, colorpower=colorpower,
+                                colorscale=self.colorscale, scale=scale, limitnb=limitnb,
+                                sampling=sampling, seed=seed, percmode=percmode,
+                                compact=compact, scalar=scalar, keepnan=keepnan)
+            cached = cache.load(key)
+            
+        if cached is not None:
+            points, meta = cached
+            vmin, vmax = meta['vmin'], meta['vmax']
+            if scalar:
+                self.quantiles = Quantiles()
+                for start in range(0, points.size, chunksize):
+                    self.quantiles.update(points['c'][start:start+chunksize])
+        else:
+            points, vmin, vmax = self._process(reader, chunksize)
+            if cache is not None and len(reader.paths) > 0:
+                cache.save(key, points, vmin=float(vmin), vmax=float(vmax))
+        self.vmin, self.vmax = vmin, vmax
+        
+        # the colorbar is only drawn when needed (see overlay.Overlay)
+        self.colorbar = dict(cmap=cmap, vmin=float(vmin),
+                             vmax=float(vmax), colorpower=float(colorpower), unit=flux_unit)
+        
+        self.points = points
+        self.colors = points['c']
+        self.posx = points['x']
+        self.posy = points['y']
+        self.posz = points['z']
+        if scalar:
+            self.xyzrgba = None
+        else:
+            self.xyzrgba = [self.posx, self.posy, self.posz] + [
+                points['rgba'][:,i] for i in range(4)]
+
+        self.peak_memory = utils.get_peak_memory()
+        if self.peak_memory is not None:
+            logger.info('peak resident memory: {:.1f} MB'.format(self.peak_memory))
+        logger.info('map loaded')
+
+    @classmethod
+    def from_maps(cls, flux, velocity, cmap, fluxperc=90, threshold=None, center=None,
+                  xyscale=None, vcenter=None, vscale=None, **kwargs):
+        """Return a map of the pixels of 2D flux and velocity maps (e.g.
+        SITELLE products): x and y are the pixel coordinates and z is
+        the velocity. The maps are read by chunks (see
+        readers.MapsReader for the parameters) and never written to an
+        intermediate file.
+
+        :param flux: 2D flux map, or path to a FITS image
+          (memory-mapped)
 
+        :param velocity: 2D velocity map, or path to a FITS image
+
+        :param kwargs: other parameters of Map3d
+        """
+        reader = readers.MapsReader(
+            flux, velocity, fluxperc=fluxperc, threshold=threshold, center=center,
+            xyscale=xyscale, vcenter=vcenter, vscale=vscale,
+            chunksize=kwargs.get('chunksize', 1000000))
+        return cls(reader, cmap, **kwargs)
+
+    @classmethod
+    def from_cube(cls, cube, restwl, cmap, spectral=None, axis='wavelength',
+                  channels=None, fluxperc=99, threshold=None, center=None, xyscale=None,
+                  vcenter=None, vscale=None, **kwargs):
+        """Return a map of the voxels of a 3D spectral cube: x and y are
+        the pixel coordinates and z is the velocity of the channel
+        relative to the rest wavelength of a line. The cube is read
+        channel by channel (see readers.CubeReader for the
+        parameters).
+
+        :param cube: (nchannels, ny, nx) cube, or path to a FITS cube
+          (memory-mapped)
+
+        :param restwl: rest wavelength (or wavenumber) of the line
+
+        :param kwargs: other parameters of Map3d
+        """
+        reader = readers.CubeReader(
+            cube, restwl, spectral=spectral, axis=axis, channels=channels,
+            fluxperc=fluxperc, threshold=threshold, center=center, xyscale=xyscale,
+            vcenter=vcenter, vscale=vscale, chunksize=kwargs.get('chunksize', 1000000))
+        return cls(reader, cmap, **kwargs)
         
-        self.data = pyfits.open(path)[0].data
-        logger.info('data shape: {}'.format(self.data.shape))
-        if self.data.ndim != 2: raise Exception('Bad data shape - Should be (N, 4)')
-        if np.any(self.data.shape == 4): raise Exception('Bad data shape - Should be (N, 4)')
-        if self.data.shape[1] == 4:
-            self.data = self.data.T
+    @property
+    def cbar_path(self):
+        """Path to a colorbar image of the map (generated with
+        matplotlib in the cache directory if needed).
+        """
+        return ovids3d.ext.cbar.get_colorbar_path(cache.CACHE_DIR, **self.colorbar)
         
-        self.cmap = cmap
+    @staticmethod
+    def get_points_dtype(compact=False, scalar=False):
+        """Return the dtype of the processed points: positions (x, y,
+        z), colors (rgba) and normalized flux (c). In scalar mode, there
+        is no color and c is the raw flux.
+        """
+        if scalar:
+            return np.dtype([('x', np.float32), ('y', np.float32), ('z', np.float32),
+                             ('c', np.float32)])
+        return np.dtype([('x', np.float32), ('y', np.float32), ('z', np.float32),
+                         ('rgba', np.uint8 if compact else np.float32, 4),
+                         ('c', np.float32)])
+
+    def get_float_xyzrgba(self):
+        """Return a float32 (7, N) copy of xyzrgba with colors between 0
+        and 1 whatever the storage.
+        """
+        xyzrgba = np.array(self.xyzrgba, dtype=np.float32)
+        if self.xyzrgba[3].dtype == np.uint8:
+            xyzrgba[3:] /= 255.
+        return xyzrgba
+    
+    def _process(self, reader, chunksize):
+        """Read and process the data. Return a structured array of
+        points (see get_points_dtype) and the flux limits vmin, vmax.
+        """
+        reader.open()
+        size = reader.size
+        get_chunk = reader.get_chunk
+            
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            #Z, X, Y, C = self.data
-            X, Y, Z, C = self.data
-            self.posx = X * scale  
-            self.posy = Y * scale
-            self.posz = Z * scale
-
-            colors = C
-            vmin = np.nanpercentile(colors, perc[0])
-            vmax = np.nanpercentile(colors, perc[1])
+
+            def is_above(icolors, vlow):
+                # the fluxes are compared on their sortable keys, as in
+                # Quantiles.count_from (-0.0 is lower than 0.0), so that
+                # the points counted are the points kept
+                return ((Quantiles.to_keys(icolors) >= Quantiles.to_keys(vlow)[0])
+                        & np.isfinite(icolors))
             
-            colors -= vmin
-            colors /= (vmax - vmin)
-            colors[colors < 0] = np.nan
-            colors[colors > 1] = 1
-            colors = colors ** colorpower
-            self.colors = colors
-
-            nonan = ~np.isnan(self.colors)
-            self.posx = self.posx[nonan]
-            self.posy = self.posy[nonan]
-            self.posz = self.posz[nonan]
-            self.colors = self.colors[nonan]
+            # first pass: flux only
+            percmode = self.percmode
+            if percmode == 'auto':
+                percmode = 'exact' if size <= self.EXACT_PERC_MAXSIZE else 'approx'
+            if percmode not in ('exact', 'approx'):
+                raise Exception("percmode must be 'auto', 'exact' or 'approx'")
+            colors = None
+            quantiles = None
+            if percmode == 'exact':
+                colors = np.empty(size, dtype=np.float32)
+            if percmode == 'approx' or self.scalar:
+                quantiles = Quantiles()
+            # bounds of the coordinates (for the spatial sort)
+            lo, hi = np.inf, -np.inf
             
-            # generate colorbar png
-            self.cbar_path = path + '.cbar.png'
-            ovids3d.ext.cbar.make_colorbar(self.cbar_path, vmin, vmax, cmap, unit=flux_unit,
-                                           colorpower=colorpower)
-
-            # compute rgba colors
-            if isinstance(cmap, str):
-                RGBA = getattr(matplotlib.cm, cmap)(self.colors)
-            else:
-                RGBA = cmap(self.colors)
-            RGBA[:,3] = 1
-            RGBA *= np.array(colorscale)
+            for start in range(0, size, chunksize):
+                stop = min(start + chunksize, size)
+                ichunk = get_chunk(start, stop)
+                iflux = ichunk[3]
+                self._report('flux limits', stop / size)
+                if colors is not None:
+                    colors[start:stop] = iflux
+                if quantiles is not None:
+                    quantiles.update(iflux)
+                ixyz = ichunk[:3][np.isfinite(ichunk[:3])]
+                if ixyz.size > 0:
+                    lo = min(lo, np.min(ixyz))
+                    hi = max(hi, np.max(ixyz))
+                del ichunk, ixyz
 
-            xyzrgbac = (self.posx, self.posy, self.posz,
-                       RGBA[:,0], RGBA[:,1],
-                       RGBA[:,2], RGBA[:,3], self.colors)
+            if percmode == 'exact':
+                vmin, vmax = np.nanpercentile(colors, self.perc).astype(np.float32)
+                nb = np.count_nonzero(is_above(colors, vmin))
+                del colors
+            else:
+                vmin, vmax = quantiles.get(self.perc)
+                nb = quantiles.count_from(vmin)
+            logger.info('flux limits: {} {} ({})'.format(vmin, vmax, percmode))
+            if not vmax > vmin:
+                # constant flux (or equal percentiles): any span gives
+                # the lowest color
+                vmax = np.float32(vmin + max(1, abs(vmin)))
+                logger.info('null flux range, vmax set to {}'.format(vmax))
             
-            xyzrgbac = np.array(pixelsort(*xyzrgbac))
-            pyfits.writeto('.temp.fits', xyzrgbac, overwrite=True)
-            if limitnb is not None:
-                randpix = np.arange(xyzrgbac.shape[1])
-                np.random.shuffle(randpix)
-                randpix = randpix[:limitnb]
-                xyzrgbac = xyzrgbac[:,randpix]
-        
-            self.xyzrgba = xyzrgbac[:-1,:]
-            self.colors = np.squeeze(xyzrgbac[-1,:])
-                
-            self.posx = self.xyzrgba[0]
-            self.posy = self.xyzrgba[1]
-            self.posz = self.xyzrgba[2]
+            if self.scalar:
+                # all the valid points are kept
+                nb = size if self.keepnan else quantiles.count
+                self.quantiles = quantiles
+                vlow = -np.inf
+            else:
+                lut = ColorLUT(self.cmap, colorpower=self.colorpower, colorscale=self.colorscale)
+                vlow = vmin
             
-            logger.info('map loaded')
+            def get_valid(ichunk):
+                # the points with a non-finite position are always dropped
+                valid = np.all(np.isfinite(ichunk[:3]), axis=0)
+                if not self.keepnan:
+                    valid &= is_above(ichunk[3], vlow)
+                return valid
+
+            def get_weights(icolors):
+                # subsampling weights: the normalized flux (as c)
+                weights = (icolors - vmin) / (vmax - vmin)
+                if not self.scalar:
+                    weights = np.minimum(weights, 1) ** self.colorpower
+                return weights
+            
+            # spatial sort (Morton / Z-order) of the valid points: their
+            # codes are computed by chunks and sorted once, each point
+            # is then written at its rank by the second pass. nb only
+            # counts the valid fluxes and is updated with the number of
+            # valid points. With limitnb, the subsampler is fed in the
+            # same pass and only the kept points are sorted and written.
+            sampler = None
+            if self.limitnb is not None and self.limitnb < nb:
+                sampler = Subsampler(self.limitnb, mode=self.sampling, seed=self.seed)
+            bounds = sorted((lo * self.scale, hi * self.scale))
+            codes = np.empty(nb, dtype=np.uint64)
+            index = 0
+            for start in range(0, size, chunksize):
+                stop = min(start + chunksize, size)
+                ichunk = get_chunk(start, stop)
+                self._report('spatial sort', stop / size)
+                ivalid = get_valid(ichunk)
+                inb = np.count_nonzero(ivalid)
+                x, y, z = [ichunk[i,ivalid] * np.float32(self.scale) for i in range(3)]
+                codes[index:index + inb] = utils.morton_codes(x, y, z, bounds=bounds)
+                if sampler is not None and self.sampling != 'voxel':
+                    sampler.update(weights=get_weights(ichunk[3,ivalid]))
+                index += inb
+            nb = index
+            codes = codes[:nb]
             
+            keep = None
+            if sampler is not None:
+                self._report('subsampling', 0)
+                logger.info('subsampling {} points out of {} ({})'.format(
+                    self.limitnb, nb, self.sampling))
+                if self.sampling == 'voxel':
+                    # the voxels are the upper bits of the Morton codes
+                    shift = np.uint64(3 * (21 - sampler.voxelbits))
+                    for start in range(0, nb, chunksize):
+                        sampler.add_voxels((codes[start:start + chunksize] >> shift).astype(np.intp))
+                    for start in range(0, nb, chunksize):
+                        sampler.update(voxels=(codes[start:start + chunksize] >> shift).astype(np.intp))
+                keep = sampler.get()
+                codes = codes[keep]
+                
+            _s = np.argsort(codes, kind='stable')
+            del codes
+            ranks = np.empty(_s.size, dtype=np.int32 if _s.size < 2**31 else np.int64)
+            for start in range(0, _s.size, chunksize):
+                ranks[_s[start:start + chunksize]] = np.arange(start, min(start + chunksize, _s.size))
             
+            # second pass: positions and rgba colors of the kept points
+            points = np.empty(_s.size, dtype=self.get_points_dtype(self.compact, self.scalar))
+            del _s
+            index = 0
+            for start in range(0, size, chunksize):
+                stop = min(start + chunksize, size)
+                ichunk = get_chunk(start, stop)
+                self._report('colors', stop / size)
+                icolors = ichunk[3]
+                inonan = get_valid(ichunk)
+                inb = np.count_nonzero(inonan)
+                if keep is None:
+                    iranks = ranks[index:index + inb]
+                else:
+                    # kept points of the chunk
+                    ikeep = np.searchsorted(keep, (index, index + inb))
+                    iselect = np.flatnonzero(inonan)[keep[ikeep[0]:ikeep[1]] - index]
+                    inonan = np.zeros_like(inonan)
+                    inonan[iselect] = True
+                    iranks = ranks[ikeep[0]:ikeep[1]]
+                index += inb
+                if iranks.size == 0: continue
+                ipoints = np.empty(iranks.size, dtype=points.dtype)
+                for i, ax in enumerate('xyz'):
+                    ipoints[ax] = ichunk[i,inonan]
+                    ipoints[ax] *= self.scale
+                icolors = icolors[inonan]
+                if self.scalar:
+                    ipoints['c'] = icolors
+                else:
+                    icolors -= vmin
+                    icolors /= (vmax - vmin)
+                    icolors[icolors > 1] = 1
+                    ipoints['rgba'] = lut(icolors, compact=self.compact)
+                    np.power(icolors, self.colorpower, out=icolors)
+                    ipoints['c'] = icolors
+                points[iranks] = ipoints
+            del ranks
+
+        return points, vmin, vmax
 
+    def _report(self, step, fraction):
+        if self.progress is not None:
+            self.progress(step, fraction)
+        
     def show(self, axis=0, size=10000):
+        import pylab as pl
         randpix = np.arange(self.posx.size)
         np.random.shuffle(randpix)
         randpix = randpix[:size]
@@ -216,6 +707,57 @@ class Map3d(object):
         pl.scatter(ax0[randpix], ax1[randpix], c=self.colors[randpix],
                    alpha=0.01, cmap=self.cmap)
         
+#########################################################
+##### batch preprocessing ###############################
+#########################################################
+
+def _preprocess_map(spec, cache_path, cache_size):
+    # run in a worker process: the result is written into the cache
+    Map3d(cache=cache.MapCache(cache_path, cache_size), **spec)
+    return spec['path']
+
+def preprocess_maps(specs, mapcache=None, processes=None, load=True):
+    """Preprocess a list of maps in parallel in a pool of processes.
+
+    Each worker process runs Map3d and writes the processed map into
+    the on-disk cache. The results are then loaded from the cache
+    (memory-mapped): no array is sent between the processes. Maps
+    later added with the same parameters (e.g. with World.add_map)
+    are also loaded from the cache.
+
+    :param specs: list of dicts of Map3d parameters (path and cmap are
+      required), e.g. [dict(path='ha.fits', cmap='hot', perc=(3, 99))]
+
+    :param mapcache: a cache.MapCache instance (default is the default
+      cache). It must be large enough to hold all the maps.
+
+    :param processes: number of worker processes (default is the
+      number of cpus)
+
+    :param load: if True, return the list of Map3d instances (in the
+      order of specs). Else only fill the cache.
+    """
+    if mapcache is None:
+        mapcache = cache.MapCache()
+    for spec in specs:
+        if 'path' not in spec or 'cmap' not in spec:
+            raise Exception('path and cmap must be given in each map spec')
+        if not isinstance(spec['cmap'], str):
+            raise Exception('cmap must be given by name to be sent to the worker processes')
+        
+    # spawned processes do not inherit the threads (and the window) of
+    # the parent process
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context) as executor:
+        futures = [executor.submit(_preprocess_map, spec, mapcache.path,
+                                   mapcache.maxsize / 1024**3)
+                   for spec in specs]
+        for future in concurrent.futures.as_completed(futures):
+            logger.info('{} preprocessed'.format(future.result()))
+
+    if load:
+        return [Map3d(cache=mapcache, **spec) for spec in specs]
+    
 #########################################################
 ##### class Path ########################################
 #########################################################
@@ -232,6 +774,7 @@ class Path(object):
             logger.debug('{} not found, trying in paths directory'.format(filepath))
             filepath = ROOT + '/paths/' + filepath
         
+        import xml.etree.ElementTree
         nodes_xml = xml.etree.ElementTree.parse(filepath).getroot()
         posnodes = list()
         looknodes = list()
@@ -301,6 +844,7 @@ class Path(object):
             distances = np.cumsum(np.sqrt(np.sum(
                 np.diff(inodes[:,1:], axis=0)**2, axis=1)))
             distances = np.insert(distances, 0, 0)
+            import scipy.interpolate
             interpolator = scipy.interpolate.interp1d(
                 distances, inodes[:,1:], kind=iorder, axis=0)
 
@@ -318,6 +862,7 @@ class Path(object):
         return steps
         
     def plot(self, step_nb=1000, scale=1, axis=0):
+        import pylab as pl
         steps = self.get_pos_steps(step_nb)
         ax0, ax1 = np.roll(np.arange(3), axis+2)[:2] + 1
         time = np.cumsum(steps[:,0])
@@ -379,3 +924,132 @@ class DirectCore(DirectObject):
         
         
         
+
+#########################################################
+##### class Scheduler ###################################
+#########################################################
+
+class Job(object):
+    """Update callback registered in the Scheduler. Like a task, the
+    callback is called as func(job) and returns job.cont (or
+    job.done to be removed). job.time is the frame time and job.dt
+    the time elapsed since its last call.
+    """
+    cont = Task.cont
+    done = Task.done
+
+    def __init__(self, func, name, priority, rate):
+        self.func = func
+        self.name = name
+        self.priority = priority
+        self.period = None if rate is None else 1. / rate
+        self.removed = False
+        self.last = None
+        self.time = 0.
+        self.dt = 0.
+
+class Scheduler(object):
+    """Per-frame scheduler of the engine. The update callbacks of the
+    subsystems (camera, overlay, level of detail, etc.) are run by a
+    single task, by increasing priority, each one at most at a given
+    rate (e.g. 5 Hz for the numbers displayed by the overlay while the
+    camera is updated at each frame). Values read once per frame
+    (e.g. node transforms) are shared between the callbacks (see
+    get_shared).
+
+    Use get_scheduler() to get the scheduler of the application. Jobs
+    must be added and removed by the main thread.
+    """
+
+    # priorities of the jobs of the engine
+    INPUT = 0 # camera motion
+    CAMERA = 10 # camera orientation
+    VIEW = 20 # view dependent updates (level of detail, point size, etc.)
+    HUD = 30 # overlay
+    
+    def __init__(self, name='scheduler'):
+        self.name = name
+        self.jobs = list()
+        self.shared = dict()
+        self.running = False
+        taskMgr.remove(self.name)
+        taskMgr.add(self.task, self.name)
+
+    def add(self, func, name, priority=0, rate=None):
+        """Add an update callback.
+
+        :param func: called as func(job) (see Job)
+
+        :param name: name of the job. A job with the same name is
+          replaced.
+
+        :param priority: jobs are run by increasing priority
+
+        :param rate: maximum rate of the calls in Hz (None for each
+          frame)
+        """
+        self.remove(name)
+        # a new list (see remove)
+        self.jobs = sorted(self.jobs + [Job(func, name, priority, rate)],
+                           key=lambda job: job.priority)
+
+    def remove(self, name):
+        """Remove a job (if it exists).
+        """
+        for job in self.jobs:
+            if job.name == name:
+                job.removed = True
+        # a new list: the list of the current frame can still be walked
+        self.jobs = [job for job in self.jobs if job.name != name]
+
+    def has(self, name):
+        return name in [job.name for job in self.jobs]
+        
+    def get_shared(self, key, func):
+        """Return a value read once per frame: func() is only called
+        by the first job asking for key during a frame. Outside of the
+        jobs, func() is always called.
+        """
+        if not self.running:
+            return func()
+        try:
+            return self.shared[key]
+        except KeyError:
+            value = self.shared[key] = func()
+            return value
+
+    def invalidate(self, key):
+        """Forget a shared value (e.g. after a transform is changed).
+        """
+        self.shared.pop(key, None)
+
+    def task(self, task):
+        now = globalClock.getFrameTime()
+        self.running = True
+        for job in self.jobs:
+            if job.removed: continue
+            if job.last is not None:
+                if job.period is not None and now - job.last < job.period: continue
+                job.dt = now - job.last
+            else:
+                job.dt = globalClock.getDt()
+            job.time = now
+            job.last = now
+            if job.func(job) == Task.done:
+                self.remove(job.name)
+        # values changed after the jobs (e.g. by intervals) must be
+        # read again
+        self.shared.clear()
+        self.running = False
+        return Task.cont
+
+_scheduler = None
+
+def get_scheduler():
+    """Return the scheduler of the application (see Scheduler). It is
+    created at the first call.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
@@ -1,14 +1,13 @@
+import os
 import sys
+import concurrent.futures
 import numpy as np
-import time
-import astropy.io.fits as pyfits
-import scipy.spatial
 
 from direct.showbase.ShowBase import ShowBase
 from panda3d.core import DirectionalLight, VBase4, TransparencyAttrib, Vec3, Point3, NodePath
 from panda3d.physics import ActorNode, ForceNode, LinearVectorForce
 from direct.filter.CommonFilters import CommonFilters
-from panda3d.core import WindowProperties, Fog, LineSegs, Material
+from panda3d.core import WindowProperties, Fog, LineSegs, Material, ClockObject
 from direct.task.Task import Task
 from direct.particles.ParticleEffect import ParticleEffect
 from direct.interval.IntervalGlobal import Wait, Sequence, Func, ParticleInterval, Parallel
@@ -17,6 +16,8 @@ from . import overlay
 from . import core
 from . import models
 from . import utils
+from . import cache
+from . import readers
 import ovids3d.ext.grid3d
 
 import logging
@@ -27,7 +28,16 @@ logger = logging.getLogger(__name__)
 #########################################################
 
 class World(core.DirectCore):
-
+    """3d world. With offscreen=True (see core.Config), the world is
+    rendered into an offscreen buffer (no window or display is
+    needed, e.g. on render servers, with a software renderer) and the
+    clock advances by exactly 1 / config['fps'] per frame: frames are
+    rendered as fast as the machine allows and the output (e.g. a
+    movie recorded by Camera.autopilot) does not depend on its speed.
+    """
+    
+    # Cg profiles of the fragment shaders of CommonFilters
+    CG_PROFILES = ('glslf', 'arbfp1', 'fp30', 'fp40', 'gp4fp', 'gp5fp')
 
     def __init__(self, bloom=0.62, blur=0.7, gamma=0.5,
                  ink=0.4, add_farstars=False, **kwargs):
@@ -42,16 +52,28 @@ class World(core.DirectCore):
         if self.config.debug:
             logger.setLevel(logging.DEBUG)
                             
-        self.base = ShowBase()
+        if self.config.offscreen:
+            self.base = ShowBase(windowType='offscreen')
+            globalClock.setMode(ClockObject.MNonRealTime)
+            globalClock.setDt(1. / self.config['fps'])
+            # the frame times do not depend on the start time
+            globalClock.setFrameTime(0)
+        else:
+            self.base = ShowBase()
         self.base.setBackgroundColor(0,0,0)
-                
-        filters = CommonFilters(self.base.win, self.base.cam)
-        filters.setBloom(blend=np.array([1,1,1,0.]), intensity=bloom, size='large', desat=0.0)
-        filters.setBlurSharpen(blur)
-        filters.setCartoonInk(separation=ink, color=(0,0,0,1))
-        filters.setGammaAdjust(gamma)
-        filters.setHighDynamicRange()
-        #filters.setExposureAdjust(0)
+
+        gsg = self.base.win.getGsg()
+        if any(gsg.getSupportsCgProfile(profile) for profile in self.CG_PROFILES):
+            filters = CommonFilters(self.base.win, self.base.cam)
+            filters.setBloom(blend=np.array([1,1,1,0.]), intensity=bloom, size='large', desat=0.0)
+            filters.setBlurSharpen(blur)
+            filters.setCartoonInk(separation=ink, color=(0,0,0,1))
+            filters.setGammaAdjust(gamma)
+            filters.setHighDynamicRange()
+            #filters.setExposureAdjust(0)
+        else: # e.g. Mesa's software renderer
+            logger.warning('Cg shaders not supported by {}: filters disabled'.format(
+                gsg.getDriverRenderer()))
         
         self.base.disableMouse()
         self.base.enableParticles()        
@@ -65,6 +87,10 @@ class World(core.DirectCore):
         self.objects_node = self.physics_node.attachNewNode(an)
 
         self.ship = Camera(self.base, self.objects_node, self.config, add_farstars=add_farstars)
+        
+        # background loading of maps (see add_map_async)
+        self.map_loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.loading = list()
         self.ship.to_origin()
 
         if self.config.full_overlay:
@@ -87,62 +113,385 @@ class World(core.DirectCore):
          
         
     def add_map(self, path, cmap, colorscale=(1,1,1,1), ascubes=False, colorpower=1,
-                norender=False, perc=(3,99), nocbar=False, limitnb=None, cubescale=1):
-
+                norender=False, perc=(3,99), nocbar=False, limitnb=None, cubescale=1,
+                memmap=False, nocache=False, compact=False, gpucmap=False,
+                leafsize=100000, budget=None, sampling='flux', columns=None):
+        """Add a map.
+
+        :param path: path to a FITS file (see core.Map3d), to a .bam
+          model, to a converted map (see below) or a readers.Reader
+          instance (e.g. readers.MapsReader to read 2D flux and
+          velocity maps).
+
+        :param columns: names of the x, y, z and flux columns when the
+          map is read from a table (see core.Map3d).
+
+        :param ascubes: if True, each pixel is drawn as a cube (with
+          GPU instancing) instead of a point.
+
+        :param limitnb: if not None, maximum number of pixels kept.
+
+        :param sampling: subsampling mode used with limitnb: 'uniform',
+          'flux' (bright pixels are kept first) or 'voxel' (dense
+          regions are thinned first). See core.Subsampler.
+
+        :param gpucmap: if True, the colormap, the flux limits and the
+          colorpower are applied on the GPU and can be changed live
+          (see set_cmap, set_perc, set_colorpower and the console
+          commands cmap, perc, vlim and power). The map cannot be
+          combined with other maps.
+
+        :param leafsize: maximum number of points in each chunk of the
+          point cloud. The map is split in chunks along an octree and
+          chunks out of the field of view are not drawn.
+
+        :param budget: if not None, maximum number of points drawn (at
+          least leafsize). The map is then drawn with a level of detail
+          depending on the distance: far regions are drawn with a
+          flux-weighted sample of their points.
+
+        A map converted with the ovids3d-convert script (a directory
+        ending with models.ASSET_EXT) is loaded as is: it is always
+        drawn with a level of detail and the processing parameters
+        (cmap, colorpower, perc, etc.) are the ones of the conversion.
+        """
         logger.info('loading {}'.format(path))
-        if '.bam' in path:
+        isreader = isinstance(path, readers.Reader)
+        if (not isreader and path.rstrip(os.sep).endswith(models.ASSET_EXT)
+            and os.path.isdir(path)):
+            if hasattr(self, 'pixels'):
+                raise Exception('converted maps cannot be combined with other maps')
+            asset = models.MapAsset(path)
+            if not norender:
+                self.pixels = models.Pixels(self.objects_node, asset, budget=budget,
+                                            scale=self.config['spacescale'] / asset.scale)
+                self._add_pixels_info()
+            cbar = asset.colorbar
+            cbar_path = asset.cbar_path
+            
+        elif not isreader and '.bam' in path:
             self.pixels = loader.loadModel(path, noCache=True)
             self.pixels.setScale(self.config['spacescale'])
             self.pixels.reparentTo(self.objects_node)
             self.pixels.setTransparency(True)
             self.pixels.setColorScale(colorscale)
+            cbar = None
             cbar_path = path + '.cbar.png'
             
-        elif '.fits' in path:
+        elif isreader or readers.get_reader_class(path) is not None:
+            if isinstance(getattr(self, 'pixels', None), models.LayerPixels):
+                raise Exception('maps cannot be combined with layers, use add_layer')
+                
             map3d = core.Map3d(path, cmap, scale=self.config['spacescale'],
                                colorpower=colorpower, colorscale=colorscale, perc=perc,
-                               limitnb=limitnb)
-    
-            if hasattr(self, 'map3d'):
-                del self.config['cbar_path']
+                               limitnb=limitnb, sampling=sampling, memmap=memmap,
+                               cache=self._get_cache(nocache), compact=compact, scalar=gpucmap,
+                               columns=columns)
+
+            if gpucmap:
+                if hasattr(self, 'map3d'):
+                    raise Exception('a map colored on the GPU cannot be combined with other maps')
+                self.map3d = map3d
+                self.nb_of_added_maps = 1
+                if not norender:
+                    self.pixels = self._make_pixels(self.map3d, self.objects_node,
+                                                    gpucmap=True, leafsize=leafsize,
+                                                    budget=budget)
+                    self._add_pixels_commands()
+                    self._add_pixels_info()
+                
+            elif hasattr(self, 'map3d'):
                 if np.any(map3d.posx != self.map3d.posx):
                     raise Exception('posx not the same')
-                xyzrgba = map3d.xyzrgba
-                new_xyzrgba = np.array(xyzrgba)
-                
-                new_xyzrgba[3:,:] += np.array(self.map3d.xyzrgba)[3:,:] 
-                self.map3d.xyzrgba = new_xyzrgba
+                new_xyzrgba = map3d.get_float_xyzrgba()
+                new_xyzrgba[3:,:] += self.map3d.get_float_xyzrgba()[3:,:]
+                self.map3d.xyzrgba = list(new_xyzrgba)
                 self.nb_of_added_maps += 1
             else:
                 self.map3d = map3d
                 self.nb_of_added_maps = 1
                 
-            cbar_path = self.map3d.cbar_path
-            if not norender:
-                xyzrgba = np.array(self.map3d.xyzrgba)
-                xyzrgba[6,:] /= self.nb_of_added_maps
-                self.map3d.xyzrgba = list(xyzrgba)
-                self.pixels = models.Pixels(
-                    self.objects_node, self.map3d,
-                    cubescale=self.config['spacescale']*cubescale,
-                    ascubes=ascubes)
-
-                if ascubes:
-                    if self.config['spacescale'] != 1:
-                        logger.warning('space scale != 1. conversion will not have a normal scale.')
-                    logger.info('writing converted data to {}. this file can be loaded instead for a much faster loading process (but make sure that the spacescale was set to 1.)'.format(path + '.bam'))
-                    self.pixels.node.writeBamFile(path + '.bam')
+            cbar = self.map3d.colorbar
+            cbar_path = None
+            if not (norender or gpucmap):
+                if self.nb_of_added_maps > 1:
+                    xyzrgba = self.map3d.get_float_xyzrgba()
+                    xyzrgba[6,:] /= self.nb_of_added_maps
+                    self.map3d.xyzrgba = list(xyzrgba)
+                if isinstance(getattr(self, 'pixels', None), models.Pixels):
+                    self.pixels.destroy()
+                self.pixels = self._make_pixels(self.map3d, self.objects_node,
+                                                ascubes=ascubes, cubescale=cubescale,
+                                                leafsize=leafsize, budget=budget)
+                self._add_pixels_info()
 
                 render.analyze()
                 
-        else: raise StandardError('bad extension (must be fits or bam)')
+        else: raise Exception('bad extension (must be bam or a known map format, see readers.get_reader)')
 
         if not nocbar:
+            self.config['cbar'] = cbar
             self.config['cbar_path'] = cbar_path
 
         logger.info('{} loaded'.format(path))
         
+    def _make_pixels(self, map3d, parent, gpucmap=False, ascubes=False, cubescale=1,
+                     leafsize=100000, budget=None, start=True):
+        if gpucmap:
+            return models.ScalarPixels(parent, map3d, leafsize=leafsize, budget=budget,
+                                       start=start)
+        return models.Pixels(parent, map3d, cubescale=self.config['spacescale']*cubescale,
+                             ascubes=ascubes, leafsize=leafsize, budget=budget, start=start)
+
+    def add_map_async(self, path, cmap, replace=True, callback=None, colorscale=(1,1,1,1),
+                      ascubes=False, colorpower=1, perc=(3,99), nocbar=False, limitnb=None,
+                      cubescale=1, memmap=False, nocache=False, compact=False,
+                      gpucmap=False, leafsize=100000, budget=None, sampling='flux',
+                      columns=None):
+        """Load a map in the background: the map is processed and its
+        geometry is built in a worker thread while the rendering goes
+        on. The progress is displayed by the overlay. When the map is
+        ready, it is attached to the scene (by the main thread). Maps
+        are loaded one after the other.
+
+        :param replace: if True, the new map replaces the current map
+          when it is ready. Else the map cannot be combined with
+          another map (neither added nor being loaded).
+
+        :param callback: if not None, called with no argument when the
+          map is attached.
+
+        See add_map for the other parameters.
+
+        :return: a concurrent.futures.Future
+        """
+        if not (isinstance(path, readers.Reader) or readers.get_reader_class(path) is not None):
+            raise Exception('only maps read by a reader can be loaded in the background')
+        # self.loading holds the maps not attached yet
+        if not replace and (hasattr(self, 'map3d') or len(self.loading) > 0):
+            raise Exception('a map loaded in the background cannot be combined with other maps')
+        
+        def load(parent):
+            def progress(step, fraction):
+                self.config['loading'] = '{}: {} {:.0f}%'.format(
+                    os.path.basename(str(path)), step, 100 * fraction)
 
+            progress('starting', 0)
+            map3d = core.Map3d(path, cmap, scale=self.config['spacescale'],
+                               colorpower=colorpower, colorscale=colorscale, perc=perc,
+                               limitnb=limitnb, sampling=sampling, memmap=memmap,
+                               cache=self._get_cache(nocache), compact=compact,
+                               scalar=gpucmap, progress=progress, columns=columns)
+            progress('geometry', 0)
+            pixels = self._make_pixels(map3d, parent, gpucmap=gpucmap, ascubes=ascubes,
+                                       cubescale=cubescale, leafsize=leafsize, budget=budget,
+                                       start=False)
+            return map3d, pixels
+        
+        logger.info('loading {} in the background'.format(path))
+        parent = NodePath('loading')
+        future = self.map_loader.submit(load, parent)
+        self.loading.append((path, future, replace, nocbar, gpucmap, callback))
+        scheduler = core.get_scheduler()
+        if not scheduler.has('world-loadTask'):
+            scheduler.add(self.loadTask, 'world-loadTask', priority=scheduler.VIEW, rate=10)
+        return future
+
+    def loadTask(self, task):
+        if self.config.offscreen:
+            # frame-exact output: the rendering waits for the maps
+            concurrent.futures.wait([iload[1] for iload in self.loading])
+            
+        # attach the maps loaded in the background
+        while len(self.loading) > 0 and self.loading[0][1].done():
+            path, future, replace, nocbar, gpucmap, callback = self.loading.pop(0)
+            try:
+                map3d, pixels = future.result()
+            except Exception as e:
+                logger.error('{} could not be loaded: {}'.format(path, e))
+                continue
+
+            if replace:
+                self.clear_map()
+            self.map3d = map3d
+            self.nb_of_added_maps = 1
+            self.pixels = pixels
+            self.pixels.node.reparentTo(self.objects_node)
+            # the scheduler is only changed by the main thread
+            self.pixels.start()
+            if gpucmap:
+                self._add_pixels_commands()
+            self._add_pixels_info()
+            if not nocbar:
+                self.config['cbar'] = map3d.colorbar
+            logger.info('{} loaded'.format(path))
+            if callback is not None:
+                callback()
+
+        if len(self.loading) == 0:
+            self.config['loading'] = None
+            return Task.done
+        return Task.cont
+        
+    def clear_map(self):
+        """Remove the map (or the layers) from the scene.
+        """
+        if hasattr(self, 'pixels'):
+            if isinstance(self.pixels, NodePath):
+                self.pixels.removeNode()
+            else:
+                self.pixels.destroy()
+            del self.pixels
+        if hasattr(self, 'map3d'):
+            del self.map3d
+        self.nb_of_added_maps = 0
+        self._remove_pixels_commands()
+        core.get_scheduler().remove('world-pixelsInfoTask')
+        for key in ('cbar', 'cbar_path', 'points_drawn', 'points_culled'):
+            self.config.pop(key, None)
+        
+    def add_layer(self, path, cmap, name=None, colorscale=(1,1,1,1), colorpower=1,
+                  perc=(3,99), nocbar=False, limitnb=None, memmap=False, nocache=False,
+                  leafsize=100000, columns=None):
+        """Add a map as a layer. All the layers must have the same
+        positions (e.g. maps of different emission lines): the
+        positions are uploaded once and each layer only adds its flux
+        column. Layers are colored on the GPU and can be shown, hidden
+        and cross-faded at any time (see show_layer, hide_layer,
+        crossfade and the console commands show, hide, weight and
+        fade).
+
+        :param path: path to the map file or a readers.Reader instance
+
+        :param name: name of the layer (default is the file name, or
+          layer<index> for a reader without file)
+
+        :param limitnb: if not None, maximum number of pixels kept. The
+          subsampling is uniform so that all the layers keep the same
+          pixels.
+
+        :param columns: names of the x, y, z and flux columns of a table
+          (see core.Map3d), e.g. to read each layer from another flux
+          column of the same catalog. The default name of the layer is
+          then the name of the flux column.
+        """
+        logger.info('loading {}'.format(path))
+        if name is None and columns is not None:
+            name = columns[3]
+        elif name is None:
+            paths = [path] if isinstance(path, str) else path.paths
+            if len(paths) > 0:
+                name = os.path.splitext(os.path.basename(paths[0]))[0]
+        map3d = core.Map3d(path, cmap, scale=self.config['spacescale'],
+                           colorpower=colorpower, colorscale=colorscale, perc=perc,
+                           limitnb=limitnb, sampling='uniform', memmap=memmap,
+                           cache=self._get_cache(nocache), scalar=True, keepnan=True,
+                           columns=columns)
+        
+        if isinstance(getattr(self, 'pixels', None), models.LayerPixels):
+            self.pixels.add_layer(map3d, name=name)
+        else:
+            if hasattr(self, 'map3d'):
+                raise Exception('layers cannot be combined with maps added with add_map')
+            self.map3d = map3d
+            self.pixels = models.LayerPixels(self.objects_node, map3d, name=name,
+                                             leafsize=leafsize)
+            self.ship.commands['show'] = lambda layer: self.show_layer(
+                self._parse_layer(layer))
+            self.ship.commands['hide'] = lambda layer: self.hide_layer(
+                self._parse_layer(layer))
+            self.ship.commands['weight'] = lambda layer, weight: self.pixels.set_weight(
+                self._parse_layer(layer), float(weight))
+            self.ship.commands['fade'] = lambda layer0, layer1, t: self.crossfade(
+                self._parse_layer(layer0), self._parse_layer(layer1), float(t))
+            self._add_pixels_info()
+
+        if not nocbar:
+            self.config['cbar'] = map3d.colorbar
+        logger.info('{} loaded'.format(path))
+
+    def _parse_layer(self, layer):
+        # layers given in the console are strings: a number which is
+        # not the name of a layer is an index
+        if layer not in self.pixels.layers and layer.isdigit():
+            return int(layer)
+        return layer
+        
+    def show_layer(self, layer):
+        self.pixels.show_layer(layer)
+
+    def hide_layer(self, layer):
+        self.pixels.hide_layer(layer)
+
+    def crossfade(self, layer0, layer1, t):
+        """Cross-fade from layer0 (t=0) to layer1 (t=1).
+        """
+        self.pixels.crossfade(layer0, layer1, t)
+        
+    def _get_cache(self, nocache):
+        if self.config['cache'] and not nocache:
+            return cache.MapCache(self.config['cache_dir'], self.config['cache_size'])
+        return None
+        
+    def _add_pixels_info(self):
+        if self.config.full_overlay:
+            scheduler = core.get_scheduler()
+            scheduler.add(self.pixelsInfoTask, 'world-pixelsInfoTask', priority=scheduler.HUD,
+                          rate=self.config['hud_rate'])
+
+    def pixelsInfoTask(self, task):
+        drawn, total = self.pixels.get_drawn_count()
+        self.config['points_drawn'] = drawn
+        self.config['points_culled'] = total - drawn
+        return Task.cont
+        
+    def _add_pixels_commands(self):
+        # live contrast commands for maps colored on the GPU
+        self.ship.commands['cmap'] = self.set_cmap
+        self.ship.commands['perc'] = lambda pmin, pmax: self.set_perc((float(pmin), float(pmax)))
+        self.ship.commands['vlim'] = lambda vmin, vmax: self.set_limits(
+            float(vmin), float(vmax))
+        self.ship.commands['power'] = lambda power: self.set_colorpower(float(power))
+        self.accept('page_up', lambda: self.set_colorpower(self.pixels.colorpower * 1.1))
+        self.accept('page_down', lambda: self.set_colorpower(self.pixels.colorpower / 1.1))
+
+    def _remove_pixels_commands(self):
+        # the commands of the maps colored on the GPU and of the layers
+        for key in ('cmap', 'perc', 'vlim', 'power', 'show', 'hide', 'weight', 'fade'):
+            self.ship.commands.pop(key, None)
+        self.ignore('page_up')
+        self.ignore('page_down')
+        
+    def set_cmap(self, cmap):
+        """Change the colormap of a map added with gpucmap=True.
+        """
+        self.pixels.set_cmap(cmap)
+        self._update_colorbar()
+
+    def set_perc(self, perc):
+        """Change the flux limits (as percentiles) of a map added with
+        gpucmap=True.
+        """
+        self.pixels.set_perc(perc)
+        self._update_colorbar()
+
+    def set_limits(self, vmin, vmax):
+        """Change the flux limits of a map added with gpucmap=True.
+        """
+        self.pixels.set_limits(vmin, vmax)
+        self._update_colorbar()
+        
+    def set_colorpower(self, colorpower):
+        """Change the colorpower of a map added with gpucmap=True.
+        """
+        self.pixels.set_colorpower(colorpower)
+        self._update_colorbar()
+
+    def _update_colorbar(self):
+        if self.config.get('cbar', None) is not None:
+            self.config['cbar'] = dict(
+                self.config['cbar'], cmap=self.pixels.cmap, vmin=self.pixels.vmin,
+                vmax=self.pixels.vmax, colorpower=self.pixels.colorpower)
         
     def add_star(self, radius, atm_size, colorintensity=20, pos=(0,0,0),
                  color='white', atmalpha=0.7, endcolor=None, atmnb=100):
@@ -219,6 +568,7 @@ class World(core.DirectCore):
         segs.setThickness(1)
         
         xyz = Vec3((0,0,size))
+        import scipy.spatial.transform
         rotation = scipy.spatial.transform.Rotation.from_euler('XYZ', rotation, degrees=True)
         xyz = rotation.apply(xyz)
         xyz = np.array((xyz[1], xyz[2], xyz[0]))
@@ -260,6 +610,16 @@ class Camera(core.DirectCore):
 
     default_fov = 55
 
+    # keyboard flight: maximum speed (in space units per second, times
+    # movescale), roll and mouse look speeds (in degrees per second,
+    # times movescale)
+    FLY_SPEED = 2.
+    ROLL_SPEED = 30.
+    LOOK_SPEED = 20.
+    MAX_DT = 0.25 # longer frames (e.g. while loading) are slowed down
+    FLY_KEYS = (('w', Vec3(0,-1,0)), ('s', Vec3(0,1,0)), ('a', Vec3(1,0,0)),
+                ('d', Vec3(-1,0,0)), ('r', Vec3(0,0,-1)), ('f', Vec3(0,0,1)))
+
     def __init__(self, base, objects_node, config, add_farstars=True):
         super().__init__()
         
@@ -273,6 +633,9 @@ class Camera(core.DirectCore):
 
         ## Keys + mouse
         self.keysmgr = core.KeysMgr()
+
+        # extra console commands: name -> function(*args)
+        self.commands = dict()
         
         self.overlay = None
         
@@ -313,12 +676,15 @@ class Camera(core.DirectCore):
 
         
         # To set relative mode and hide the cursor:
-        props = WindowProperties()
-        #props.setCursorHidden(True)
-        props.setMouseMode(WindowProperties.M_absolute)
-        self.base.win.requestProperties(props)
+        if not self.config.offscreen:
+            props = WindowProperties()
+            #props.setCursorHidden(True)
+            props.setMouseMode(WindowProperties.M_absolute)
+            self.base.win.requestProperties(props)
 
         self.last_pos = None
+        self.velocity = Vec3(0,0,0)
+        self.looking_key = False
         self.mouse1_pressed = False
         self.mouse3_pressed = False
 
@@ -332,29 +698,29 @@ class Camera(core.DirectCore):
         self.accept('wheel_down', self.wheel_down)
 
 
+        # all the updates are run by the scheduler of the engine
+        self.scheduler = core.get_scheduler()
         self.stop_looking_at()
-        taskMgr.remove('cam-mouseMoveTask')
-        taskMgr.add(self.mouseMoveTask, 'cam-mouseMoveTask')
-        taskMgr.remove('cam-camMoveTask')
-        taskMgr.add(self.camMoveTask, 'cam-camMoveTask')
-        taskMgr.remove('cam-setDirection')
-        taskMgr.add(self.setDirectionTask, 'cam-setDirection')
+        self.scheduler.add(self.mouseMoveTask, 'cam-mouseMoveTask',
+                           priority=self.scheduler.INPUT)
+        self.scheduler.add(self.camMoveTask, 'cam-camMoveTask', priority=self.scheduler.INPUT)
+        self.scheduler.add(self.setDirectionTask, 'cam-setDirection',
+                           priority=self.scheduler.CAMERA)
         if self.overlay is not None:
-            taskMgr.remove('cam-infoTask')
-            taskMgr.add(self.infoTask, 'cam-infoTask')
+            self.scheduler.add(self.infoTask, 'cam-infoTask', priority=self.scheduler.HUD,
+                               rate=self.config['hud_rate'])
 
     def infoTask(self, task):
         # minus before getPos because the camera is not moving, only
         # the objects are. i.e. relative camera position is the
         # inverse of objects position (real camera position is always
         # 0,0,0).
-        x, y, z = - self.getPos() / self.config['spacescale']
+        pos = - self.getPos() / self.config['spacescale']
+        x, y, z = pos
         self.config['pos_xyz'] = x, y, z
         self.config['pos_sph'] = utils.xyz2sph(x, y, z)
         self.config['pos_hpr'] = self.base.camera.getHpr()
-        
-        self.config['distance'] = np.sqrt(
-            np.sum((self.getPos() / self.config['spacescale'])**2))
+        self.config['distance'] = pos.length()
         return Task.cont
 
 
@@ -364,6 +730,10 @@ class Camera(core.DirectCore):
         
         text = text.strip().split()
         key = text[0]
+
+        if key in self.commands:
+            self.commands[key](*text[1:])
+            return
         
         if len(key) > 1:
             val = np.array(text[1:], dtype=float)
@@ -395,15 +765,17 @@ class Camera(core.DirectCore):
     
     def setPos(self, pos):
         self.objects_node.setPos(pos)
+        self.scheduler.invalidate('objects-pos')
 
     def getPos(self):
         """Return position of the objects node. Don't forget that camera is
         never moving. Only the objects are moving.
         """
-        return self.objects_node.getPos()
+        return self.scheduler.get_shared('objects-pos', self.objects_node.getPos)
 
     def to_origin(self):
         #self.setPos(Vec3(0, -5 * self.config['spacescale'], 0))
+        self.velocity = Vec3(0,0,0)
         self.setPos(Vec3(0, 0, -5 * self.config['spacescale']))
         self.base.camera.lookAt(self.objects_node)
         #self.base.camera.setHpr(self.objects_node, -180, 0, -90)
@@ -443,14 +815,17 @@ class Camera(core.DirectCore):
 
 
     def mouseMoveTask(self, task):
+        # no mouse offscreen
+        if self.base.mouseWatcherNode is None: return Task.cont
         
         if self.base.mouseWatcherNode.hasMouse():
             if self.mouse1_pressed:
                 mpos = self.base.mouseWatcherNode.getMouse()  # get the mouse position
                 dx = mpos.getX()
                 dy = mpos.getY()
-                self.setHpr(-dx * self.config['movescale'],
-                            dy * self.config['movescale'], 0)
+                speed = self.LOOK_SPEED * self.config['movescale'] * min(
+                    globalClock.getDt(), self.MAX_DT)
+                self.setHpr(-dx * speed, dy * speed, 0)
                 
             if self.mouse3_pressed:
                 pass
@@ -469,12 +844,13 @@ class Camera(core.DirectCore):
     def autopilot(self, filepath, scale=1, timescale=1, record=False):
         scale *= self.config['spacescale']
         timescale *= self.config['timescale']
-        taskMgr.remove('cam-mouseMoveTask')
-        taskMgr.remove('cam-camMoveTask')
+        self.scheduler.remove('cam-mouseMoveTask')
+        self.scheduler.remove('cam-camMoveTask')
         
         self.start_looking_at('center')
         movepath = core.Path(filepath)
         possteps = movepath.get_pos_steps(10000)
+        self.velocity = Vec3(0,0,0)
         self.setPos(Point3(*possteps[0][1:] * scale))
         
         posintervals = list()
@@ -506,16 +882,22 @@ class Camera(core.DirectCore):
         parallel = Parallel(posseq, lookseq, fovseq)
         parallel.loop()
 
-        taskMgr.add(self.camMoveTask, 'cam-camMoveTask')
-        taskMgr.add(self.mouseMoveTask, 'cam-mouseMoveTask')
+        self.scheduler.add(self.camMoveTask, 'cam-camMoveTask', priority=self.scheduler.INPUT)
+        self.scheduler.add(self.mouseMoveTask, 'cam-mouseMoveTask',
+                           priority=self.scheduler.INPUT)
 
         if record:
             logger.info('recording at {} fps'.format(self.config['fps']))
-            self.base.movie(namePrefix='movie_',
-                            duration=movepath.duration,
-                            fps=self.config['fps'], 
-                            format ='jpg',
-                            sd=4, source=None)
+            movie = self.base.movie(namePrefix='movie_',
+                                    duration=movepath.duration,
+                                    fps=self.config['fps'], 
+                                    format ='jpg',
+                                    sd=4, source=None)
+            if self.config.offscreen:
+                # the clock is not reset to real time (see
+                # base.movie) and the application exits when the
+                # movie is recorded
+                movie.setUponDeath(lambda task: self.base.userExit())
 
                 
     def setDirectionTask(self, task):
@@ -541,60 +923,53 @@ class Camera(core.DirectCore):
             self.lookatnode = self.direction_node
         else:
             raise StandardError('bad direction')
-        taskMgr.remove('cam-lookAtTask')
-        taskMgr.add(self.lookAtTask, 'cam-lookAtTask')
+        self.scheduler.add(self.lookAtTask, 'cam-lookAtTask', priority=self.scheduler.CAMERA)
         
     def stop_looking_at(self):
         self.islookingat = False
-        taskMgr.remove('cam-lookAtTask')
+        self.scheduler.remove('cam-lookAtTask')
 
     def toggle_looking_at(self, direction):
         if self.islookingat: self.stop_looking_at()
         else: self.start_looking_at(direction)
         
     def camMoveTask(self, task):
-
-        time.sleep(0.05)
-        
-        SCALE = 0.1 * self.config['spacescale'] * self.config['movescale']
-        SCALEHPR = 1.5 * self.config['movescale']
-
-                    
-        #self.objects_node.node().getPhysical(0).clearLinearForces()
-
-
-        vec = Vec3(0,0,0)
+        # the motion is integrated over the time elapsed since the last
+        # frame so that the speed does not depend on the frame rate
+        dt = min(globalClock.getDt(), self.MAX_DT)
+        maxspeed = self.FLY_SPEED * self.config['spacescale'] * self.config['movescale']
+        damping = self.config['damping']
+        keys = self.keysmgr.keys
         
-        if self.keysmgr.keys.p:
+        if keys.p and not self.looking_key:
             self.toggle_looking_at('center')
+        self.looking_key = keys.p
+
+        thrust = Vec3(0,0,0)
+        for key, direction in self.FLY_KEYS:
+            if keys[key]:
+                thrust += direction
+        if thrust.length() > 0:
+            thrust.normalize()
+        thrust = self.objects_node.getRelativeVector(self.base.camera, thrust)
+
+        # exact integration of dv/dt = damping * (maxspeed * thrust - v):
+        # the velocity tends to maxspeed when a key is held and to 0
+        # when it is released
+        terminal = thrust * maxspeed
+        decay = np.exp(-damping * dt)
+        delta = self.velocity - terminal
+        self.setPos(self.getPos() + terminal * dt + delta * ((1 - decay) / damping))
+        self.velocity = terminal + delta * decay
+        
+        roll = self.ROLL_SPEED * self.config['movescale'] * dt
+        if keys.e:
+            self.setHpr(0, 0, -roll)
 
-        if self.keysmgr.keys.w:
-            vec = self.objects_node.getRelativeVector(self.base.camera, Vec3(0,-1,0))
-            
-        if self.keysmgr.keys.s:
-            vec = self.objects_node.getRelativeVector(self.base.camera, Vec3(0,1,0))
-
-        if self.keysmgr.keys.a:
-            vec = self.objects_node.getRelativeVector(self.base.camera, Vec3(1,0,0))
-
-        if self.keysmgr.keys.d:
-            vec = self.objects_node.getRelativeVector(self.base.camera, Vec3(-1,0,0))
-
-        if self.keysmgr.keys.r:
-            vec = self.objects_node.getRelativeVector(self.base.camera, Vec3(0,0,-1))
-
-        if self.keysmgr.keys.f:
-            vec = self.objects_node.getRelativeVector(self.base.camera, Vec3(0,0,1))
-            
-        self.setPos(self.getPos() + vec * SCALE)
-
-        if self.keysmgr.keys.e:
-            self.setHpr(0, 0, -SCALEHPR)
-
-        if self.keysmgr.keys.q:
-            self.setHpr(0, 0, SCALEHPR)
+        if keys.q:
+            self.setHpr(0, 0, roll)
 
-        if self.keysmgr.keys.k:
+        if keys.k:
             self.to_origin()
 
         return Task.cont
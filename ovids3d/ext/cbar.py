@@ -8,10 +8,31 @@ Customized colorbars
 This example shows how to build colorbars without an attached mappable.
 '''
 
-import matplotlib.pyplot as plt
-import matplotlib as mpl
+import os
+import hashlib
+
+def get_colorbar_path(cache_dir, vmin, vmax, cmap, unit='unit', colorpower=1.):
+    """Return the path to a colorbar image. The images are kept in
+    cache_dir, keyed by their parameters, and only generated (see
+    make_colorbar) when they do not exist.
+    """
+    key = repr((getattr(cmap, 'name', cmap), float(vmin), float(vmax), str(unit),
+                float(colorpower)))
+    path = os.path.join(cache_dir, 'cbar-{}.png'.format(
+        hashlib.blake2b(key.encode(), digest_size=20).hexdigest()))
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp.png'.format(path[:-4], os.getpid())
+        make_colorbar(tmp_path, vmin, vmax, cmap, unit=unit, colorpower=colorpower)
+        os.replace(tmp_path, path)
+    return path
 
 def make_colorbar(path, vmin, vmax, cmap, unit='unit', colorpower=1.):
+    # matplotlib is only imported when a colorbar image is needed
+    import matplotlib.pyplot as plt
+    import matplotlib as mpl
+    import matplotlib.colorbar
+    
     # Make a figure and axes with dimensions as desired.
     fig = plt.figure(figsize=(4, 4))
     ax1 = fig.add_axes([0.05, 0.05, 0.2/4, 0.9])
@@ -36,4 +57,5 @@ def make_colorbar(path, vmin, vmax, cmap, unit='unit', colorpower=1.):
     
     plt.savefig(path, transparent=True, dpi=300)#, bbox_inches='tight')
     #plt.show()
+    plt.close(fig)
 
@@ -1,14 +1,681 @@
 import numpy as np
 import os
-import sys
 import logging
 logger = logging.getLogger(__name__)
+import concurrent.futures
+import heapq
+import json
 
-from panda3d.core import TextureStage, Material, TransparencyAttrib, GeomVertexFormat, GeomVertexData, Geom, GeomPoints, GeomVertexWriter, GeomNode, NodePath, RenderModeAttrib, PointLight, VBase4, Vec3, LineSegs, AmbientLight, Vec4
+from panda3d.core import TextureStage, Material, TransparencyAttrib, GeomVertexFormat, GeomVertexData, Geom, GeomPoints, GeomNode, NodePath, RenderModeAttrib, PointLight, VBase4, Vec3, LineSegs, AmbientLight, Vec4
+from panda3d.core import GeomVertexArrayFormat, InternalName, Shader, ShaderAttrib, Texture, SamplerState
+from panda3d.core import PandaNode, BoundingVolume, BoundingBox, GeomEnums, Point3
+from panda3d.core import GeomVertexArrayData, PTA_LVecBase4f
 
 from . import core
 from . import constants
 from . import utils
+import ovids3d.ext.cbar
+
+#########################################################
+##### points geometry ###################################
+#########################################################
+
+V3C4_DTYPE = np.dtype([('vertex', np.float32, 3), ('color', np.uint8, 4)])
+
+def make_points(name, xyz, rgba, chunksize=1000000):
+    """Return a GeomNode containing a non-indexed point cloud. The
+    vertex array is filled in bulk from numpy arrays, through its
+    memoryview.
+
+    :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+    :param rgba: sequence of 4 arrays of N float colors in [0, 1] (or
+      uint8 colors). Float colors are converted as Panda3D does
+      (clipped and truncated).
+    
+    :param chunksize: number of points converted at once
+    """
+    nb = np.size(xyz[0])
+    vformat = GeomVertexFormat.getV3c4()
+    assert vformat.getArray(0).getStride() == V3C4_DTYPE.itemsize, 'unexpected vertex format'
+    
+    vdata = GeomVertexData('vdata', vformat, Geom.UHStatic)
+    vdata.uncleanSetNumRows(nb)
+    buf = np.frombuffer(memoryview(vdata.modifyArray(0)).cast('B'), dtype=V3C4_DTYPE)
+
+    for start in range(0, nb, chunksize):
+        stop = min(start + chunksize, nb)
+        for i in range(3):
+            buf['vertex'][start:stop,i] = xyz[i][start:stop]
+        for i in range(4):
+            icolors = np.asarray(rgba[i][start:stop])
+            if icolors.dtype != np.uint8:
+                icolors = np.clip(icolors * 255, 0, 255).astype(np.uint8)
+            buf['color'][start:stop,i] = icolors
+    del buf
+    
+    return _make_points_node(name, vdata, nb)
+
+def make_vertex_points(name, vertices, scale=1.):
+    """Return a GeomNode containing a non-indexed point cloud from an
+    array of V3C4_DTYPE records, copied as is into the vertex array.
+
+    :param scale: scale applied to the positions
+    """
+    nb = vertices.size
+    vdata = GeomVertexData('vdata', GeomVertexFormat.getV3c4(), Geom.UHStatic)
+    vdata.uncleanSetNumRows(nb)
+    buf = np.frombuffer(memoryview(vdata.modifyArray(0)).cast('B'), dtype=V3C4_DTYPE)
+    buf[:] = vertices
+    if scale != 1:
+        buf['vertex'] *= np.float32(scale)
+    del buf
+    return _make_points_node(name, vdata, nb)
+
+V3S1_DTYPE = np.dtype([('vertex', np.float32, 3), ('scalar', np.float32)])
+
+def get_v3s1_format():
+    """Return the vertex format of scalar point clouds: float32
+    positions and one float32 'scalar' column.
+    """
+    array = GeomVertexArrayFormat()
+    array.addColumn(InternalName.make('vertex'), 3, Geom.NT_float32, Geom.C_point)
+    array.addColumn(InternalName.make('scalar'), 1, Geom.NT_float32, Geom.C_other)
+    return GeomVertexFormat.registerFormat(GeomVertexFormat(array))
+
+def make_scalar_points(name, xyz, scalars, chunksize=1000000):
+    """Return a GeomNode containing a non-indexed point cloud whose
+    vertices hold a scalar value instead of a color (see
+    ScalarPixels).
+
+    :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+    :param scalars: array of N scalar values
+    """
+    nb = np.size(xyz[0])
+    vformat = get_v3s1_format()
+    assert vformat.getArray(0).getStride() == V3S1_DTYPE.itemsize, 'unexpected vertex format'
+
+    vdata = GeomVertexData('vdata', vformat, Geom.UHStatic)
+    vdata.uncleanSetNumRows(nb)
+    buf = np.frombuffer(memoryview(vdata.modifyArray(0)).cast('B'), dtype=V3S1_DTYPE)
+    for start in range(0, nb, chunksize):
+        stop = min(start + chunksize, nb)
+        for i in range(3):
+            buf['vertex'][start:stop,i] = xyz[i][start:stop]
+        buf['scalar'][start:stop] = scalars[start:stop]
+    del buf
+
+    return _make_points_node(name, vdata, nb)
+    
+def _make_points_node(name, vdata, nb):
+    geompoints = GeomPoints(Geom.UHStatic)
+    geompoints.addConsecutiveVertices(0, nb)
+    geompoints.closePrimitive()
+
+    geom = Geom(vdata)
+    geom.addPrimitive(geompoints)
+    gnode = GeomNode(name)
+    gnode.addGeom(geom)
+    return gnode
+
+def get_octree(xyz, leafsize):
+    """Return an octree built over a point cloud. The octree cells
+    are contiguous ranges of the Morton order (see
+    utils.morton_codes): a cell is split in 8 until it contains less
+    than leafsize points. Empty cells are not kept and a cell whose
+    points all fall in the same child is directly split further.
+
+    :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+    :param leafsize: maximum number of points in a leaf
+
+    :return: (order, cells). order is the Morton order of the points
+      (None if they are already sorted). cells is a list of [start,
+      stop, children] where (start, stop) is a range of this order
+      and children is the list of the indices of the child cells. The
+      first cell is the root and children always come after their
+      parent.
+    """
+    bits = 21
+    cells = list()
+    if np.size(xyz[0]) == 0:
+        return None, cells
+    
+    codes = utils.morton_codes(*xyz, bits=bits)
+    if np.any(codes[1:] < codes[:-1]):
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+    else:
+        order = None
+    
+    cells.append([0, codes.size, list()])
+    todo = [(0, 0, 0)] # cell index, depth, prefix
+    while len(todo) > 0:
+        icell, depth, prefix = todo.pop()
+        start, stop, children = cells[icell]
+        if stop - start <= leafsize: continue
+        
+        while depth < bits:
+            shift = np.uint64(3 * (bits - depth - 1))
+            keys = np.array([prefix * 8 + i for i in range(9)], dtype=np.uint64)
+            edges = start + np.searchsorted(codes[start:stop] >> shift, keys)
+            nonempty = [i for i in range(8) if edges[i+1] > edges[i]]
+            if len(nonempty) > 1: break
+            depth += 1
+            prefix = prefix * 8 + nonempty[0]
+        else: continue # all the points are at the same position
+        
+        for i in nonempty:
+            cells.append([int(edges[i]), int(edges[i+1]), list()])
+            children.append(len(cells) - 1)
+            todo.append((len(cells) - 1, depth + 1, prefix * 8 + i))
+            
+    return order, cells
+
+def get_octree_leaves(xyz, leafsize):
+    """Return the leaves of an octree built over a point cloud (see
+    get_octree).
+
+    :return: (order, leaves). order is the Morton order of the points
+      (None if they are already sorted) and leaves is a list of
+      (start, stop) ranges of this order.
+    """
+    order, cells = get_octree(xyz, leafsize)
+    return order, sorted([(start, stop) for start, stop, children in cells
+                          if len(children) == 0])
+
+def _make_chunk(name, index, xyz, rgba=None, scalars=None):
+    ixyz = [np.asarray(ax[index]) for ax in xyz]
+    if scalars is not None:
+        gnode = make_scalar_points(name, ixyz, np.asarray(scalars[index]))
+    else:
+        gnode = make_points(name, ixyz, [np.asarray(c[index]) for c in rgba])
+    gnode.setBoundsType(BoundingVolume.BT_box)
+    return gnode
+
+def make_chunked_points(name, xyz, rgba=None, scalars=None, leafsize=100000, threads=None):
+    """Return a PandaNode whose children are GeomNodes containing
+    the octree leaves of a point cloud (see get_octree_leaves). Each
+    chunk has tight bounds so that whole chunks can be culled. Chunks
+    are built in parallel threads.
+
+    :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+    :param rgba: sequence of 4 arrays of N colors (see make_points)
+
+    :param scalars: array of N scalars (see make_scalar_points), used
+      instead of rgba.
+
+    :param leafsize: maximum number of points in a chunk
+
+    :param threads: number of worker threads (default is the number of
+      cpus)
+
+    :return: (node, leaves)
+    """
+    order, leaves = get_octree_leaves(xyz, leafsize)
+
+    def build(ileaf):
+        start, stop = leaves[ileaf]
+        if order is None:
+            index = slice(start, stop)
+        else:
+            index = order[start:stop]
+        return _make_chunk('{}-{}'.format(name, ileaf), index, xyz,
+                           rgba=rgba, scalars=scalars)
+    
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        gnodes = list(executor.map(build, range(len(leaves))))
+
+    node = PandaNode(name)
+    for gnode in gnodes:
+        node.addChild(gnode)
+    logger.info('{} points split in {} chunks'.format(np.size(xyz[0]), len(leaves)))
+    return node, leaves
+
+def make_instance_texture(xyz, rgba):
+    """Return a buffer texture holding the positions and the colors of
+    a set of instances (see make_chunked_cubes): 2 float texels per
+    instance, (x, y, z, 1) and (r, g, b, a).
+
+    :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+    :param rgba: sequence of 4 arrays of N float colors in [0, 1] (or
+      uint8 colors)
+    """
+    nb = np.size(xyz[0])
+    data = np.empty((nb, 2, 4), dtype=np.float32)
+    for i in range(3):
+        data[:,0,i] = xyz[i]
+    data[:,0,3] = 1
+    for i in range(4):
+        icolors = np.asarray(rgba[i])
+        if icolors.dtype == np.uint8:
+            data[:,1,i] = icolors / np.float32(255)
+        else:
+            data[:,1,i] = icolors
+
+    tex = Texture('instances')
+    tex.setupBufferTexture(2 * nb, Texture.T_float, Texture.F_rgba32, GeomEnums.UH_static)
+    tex.setRamImage(data.tobytes())
+    return tex
+
+def make_chunked_cubes(name, cube, xyz, rgba, size, leafsize=100000, threads=None):
+    """Return a NodePath whose children draw the octree leaves of a
+    point cloud (see get_octree_leaves) as instanced cubes: the cube
+    mesh is drawn once per point, with the position and the color
+    read from a buffer texture (see make_instance_texture and
+    shaders/cubes.vert).
+
+    :param cube: GeomNode of the cube mesh
+
+    :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+    :param rgba: sequence of 4 arrays of N colors
+
+    :param size: scale of the cube mesh
+
+    :return: (nodepath, leaves)
+    """
+    order, leaves = get_octree_leaves(xyz, leafsize)
+
+    def build(ileaf):
+        start, stop = leaves[ileaf]
+        if order is None:
+            index = slice(start, stop)
+        else:
+            index = order[start:stop]
+        ixyz = [np.asarray(ax[index]) for ax in xyz]
+        bounds = [Point3(*[float(f(ax)) + sign * size for ax in ixyz])
+                  for f, sign in ((np.min, -1), (np.max, 1))]
+        return make_instance_texture(ixyz, [np.asarray(c[index]) for c in rgba]), bounds
+    
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        chunks = list(executor.map(build, range(len(leaves))))
+
+    nodepath = NodePath(PandaNode(name))
+    nodepath.setShader(Shader.load(Shader.SL_GLSL,
+                                   vertex=core.ROOT + '/shaders/cubes.vert',
+                                   fragment=core.ROOT + '/shaders/cubes.frag'))
+    nodepath.setShaderInput('cubesize', float(size))
+    for ileaf, (tex, bounds) in enumerate(chunks):
+        gnode = cube.makeCopy()
+        gnode.setName('{}-{}'.format(name, ileaf))
+        # the bounds of the mesh do not include the instances
+        gnode.setBounds(BoundingBox(*bounds))
+        gnode.setFinal(True)
+        chunk = nodepath.attachNewNode(gnode)
+        chunk.setShaderInput('instances', tex)
+        chunk.setInstanceCount(leaves[ileaf][1] - leaves[ileaf][0])
+        
+    logger.info('{} cubes split in {} chunks'.format(np.size(xyz[0]), len(leaves)))
+    return nodepath, leaves
+
+def count_drawn_points(nodepath, leaves):
+    """Return the number of points of a chunked point cloud (see
+    make_chunked_points) in the camera frustum.
+    """
+    lens_bounds = base.camLens.makeBounds()
+    lens_bounds.xform(base.cam.getMat(nodepath))
+    drawn = 0
+    for child, (start, stop) in zip(nodepath.getChildren(), leaves):
+        if lens_bounds.contains(child.node().getBounds()):
+            drawn += stop - start
+    return drawn
+
+def get_pointscale():
+    """Return the size in pixels of an object of size 1 at a distance
+    of 1 (the perspective point size of Panda3D's fixed-function
+    pipeline). It is read once per frame (see core.Scheduler.get_shared).
+    """
+    def read():
+        fov = base.camLens.getFov()[1]
+        return base.win.getYSize() / np.tan(np.deg2rad(fov) / 2)
+    return core.get_scheduler().get_shared('pointscale', read)
+
+def make_cmap_texture(cmap, size=256, colorpower=1, vertical=False):
+    """Return a (size x 1) texture of a colormap (see core.ColorLUT),
+    built in memory.
+
+    :param vertical: if True, the texture is (1 x size), e.g. to draw
+      a colorbar.
+    """
+    lut = core.ColorLUT(cmap, colorpower=colorpower, size=size)
+    tex = Texture('cmap')
+    if vertical:
+        tex.setup2dTexture(1, size, Texture.T_unsigned_byte, Texture.F_rgba8)
+    else:
+        tex.setup2dTexture(size, 1, Texture.T_unsigned_byte, Texture.F_rgba8)
+    tex.setRamImageAs(lut.rgba8.tobytes(), 'RGBA')
+    tex.setWrapU(SamplerState.WM_clamp)
+    tex.setWrapV(SamplerState.WM_clamp)
+    tex.setMinfilter(SamplerState.FT_linear)
+    tex.setMagfilter(SamplerState.FT_linear)
+    return tex
+
+def get_lod(xyz, leafsize, weights=None, seed=0):
+    """Return the cells of a multi-resolution point cloud (see
+    PointLOD): an octree (see get_octree) whose leaves hold all their
+    points and whose inner cells hold a weighted sample of leafsize
+    points.
+
+    The samples are nested: each point gets a random key log(u)/w
+    (weighted sampling without replacement), and a cell keeps the
+    points of largest key among the points of its children.
+
+    :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+    :param leafsize: maximum number of points in a cell
+
+    :param weights: array of N sampling weights (e.g. the flux). If
+      None the samples are uniform.
+
+    :param seed: seed of the sampling
+
+    :return: (order, cells, samples, boxes). order and cells are
+      returned by get_octree. samples is the list of the indices (in
+      the Morton order) of the points of each cell and boxes is a
+      (ncells, 2, 3) array of the (min, max) corners of the cells.
+    """
+    total = np.size(xyz[0])
+    order, cells = get_octree(xyz, leafsize)
+    
+    rng = np.random.default_rng(seed)
+    if weights is None:
+        weights = np.ones(total, dtype=np.float32)
+    weights = np.clip(np.nan_to_num(np.asarray(weights, dtype=np.float64)), 0, None)
+    if order is not None:
+        weights = weights[order]
+    weights += 1e-6 * np.max(weights, initial=0) + 1e-30
+    keys = np.log(1 - rng.random(total)) / weights
+    del weights
+    
+    sorted_xyz = [np.asarray(ax) if order is None else np.asarray(ax)[order]
+                  for ax in xyz]
+    samples = [None] * len(cells)
+    boxes = np.empty((len(cells), 2, 3), dtype=np.float64)
+    for icell in reversed(range(len(cells))):
+        start, stop, ichildren = cells[icell]
+        if len(ichildren) == 0:
+            samples[icell] = np.arange(start, stop)
+            for i in range(3):
+                boxes[icell,0,i] = np.min(sorted_xyz[i][start:stop])
+                boxes[icell,1,i] = np.max(sorted_xyz[i][start:stop])
+        else:
+            isample = np.concatenate([samples[ichild] for ichild in ichildren])
+            if isample.size > leafsize:
+                isample = np.sort(isample[np.argpartition(
+                    keys[isample], -leafsize)[-leafsize:]])
+            samples[icell] = isample
+            boxes[icell,0] = np.min(boxes[ichildren,0], axis=0)
+            boxes[icell,1] = np.max(boxes[ichildren,1], axis=0)
+    return order, cells, samples, boxes
+
+#########################################################
+##### class PointLOD ####################################
+#########################################################
+
+class PointLOD(object):
+    """Multi-resolution point cloud. Each cell of an octree (see
+    get_lod) is a chunk: leaves hold all their points and inner
+    cells a flux-weighted sample of leafsize points, drawn bigger. At
+    each update, the cells are refined, starting from the root, as
+    long as their screen-space error is larger than maxerror pixels
+    and the number of points in the field of view stays below budget.
+    """
+
+    def __init__(self, name, xyz, rgba=None, scalars=None, weights=None,
+                 leafsize=100000, budget=2000000, maxerror=1., thickness=3.8,
+                 threads=None, seed=0):
+        """
+        :param xyz: sequence of 3 arrays of N positions (x, y, z)
+
+        :param rgba: sequence of 4 arrays of N colors (see make_points)
+
+        :param scalars: array of N scalars (see make_scalar_points),
+          used instead of rgba. The point size is then set through the
+          'thickness' shader input.
+
+        :param weights: array of N sampling weights (e.g. the flux). If
+          None the samples are uniform.
+
+        :param leafsize: maximum number of points in a chunk
+
+        :param budget: maximum number of points drawn. The root cell
+          is always drawn: budget must be at least leafsize (or N).
+
+        :param maxerror: maximum screen-space error in pixels
+
+        :param thickness: size of the points of the leaves
+        """
+        self._check_budget(budget, min(leafsize, np.size(xyz[0])))
+        order, cells, samples, boxes = get_lod(xyz, leafsize, weights=weights, seed=seed)
+        
+        def build(icell, index):
+            if order is not None:
+                index = order[index]
+            return _make_chunk('{}-{}'.format(name, icell), index, xyz,
+                               rgba=rgba, scalars=scalars)
+    
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            gnodes = list(executor.map(build, range(len(cells)), samples))
+        sizes = [isample.size for isample in samples]
+        del samples
+
+        self._init_chunks(name, gnodes, [ichildren for _, _, ichildren in cells],
+                          [stop - start for start, stop, _ in cells], sizes, boxes,
+                          budget, maxerror, thickness, scalars is not None)
+
+    @classmethod
+    def from_asset(cls, name, asset, scale=1., budget=2000000, maxerror=1., thickness=3.8,
+                   threads=None):
+        """Return a PointLOD whose chunks are read from a converted map
+        (see MapAsset). The vertex data of each chunk is copied as is.
+
+        :param scale: scale applied to the positions
+        """
+        cls._check_budget(budget, asset.offsets[1] - asset.offsets[0])
+        
+        def build(icell):
+            start, stop = asset.offsets[icell], asset.offsets[icell+1]
+            gnode = make_vertex_points('{}-{}'.format(name, icell), asset.vertices[start:stop],
+                                       scale=scale)
+            gnode.setBoundsType(BoundingVolume.BT_box)
+            return gnode
+
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            gnodes = list(executor.map(build, range(asset.offsets.size - 1)))
+
+        self = cls.__new__(cls)
+        self._init_chunks(name, gnodes, asset.children, asset.counts,
+                          np.diff(asset.offsets), asset.boxes * scale,
+                          budget, maxerror, thickness, False)
+        return self
+
+    @staticmethod
+    def _check_budget(budget, rootsize):
+        # the root cell is always drawn: a smaller budget could not be
+        # respected
+        if budget < rootsize:
+            raise Exception('budget ({}) must be at least the number of points of the root cell ({}, i.e. leafsize)'.format(budget, rootsize))
+
+    def _init_chunks(self, name, gnodes, children, counts, sizes, boxes,
+                     budget, maxerror, thickness, scalar):
+        self.budget = int(budget)
+        self.maxerror = float(maxerror)
+        self.children = children
+        counts = np.asarray(counts, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.total = int(counts[0]) if counts.size > 0 else 0
+        self.centers = boxes.mean(axis=1)
+        self.radii = np.sqrt(np.sum((boxes[:,1] - boxes[:,0])**2, axis=1)) / 2
+        # mean distance between the points of a sample, 0 for the leaves
+        self.errors = np.where(counts > self.sizes,
+                               2 * self.radii / np.maximum(self.sizes, 1)**(1/3.), 0)
+        
+        self.nodepath = NodePath(PandaNode(name))
+        self.chunks = list()
+        for icell, gnode in enumerate(gnodes):
+            chunk = self.nodepath.attachNewNode(gnode)
+            ithickness = thickness * (counts[icell] / max(self.sizes[icell], 1))**(1/3.)
+            if scalar:
+                chunk.setShaderInput('thickness', ithickness)
+            else:
+                chunk.setRenderModePerspective(True)
+                chunk.setRenderModeThickness(ithickness)
+            chunk.hide()
+            self.chunks.append(chunk)
+
+        self.selected = set()
+        self.drawn = 0
+        logger.info('{} points split in {} chunks ({} leaves)'.format(
+            self.total, len(gnodes), np.sum(counts == self.sizes)))
+        
+    def get_visibility(self):
+        """Return (visible, sse): a boolean array which is True for the
+        cells in the camera frustum and their screen-space error in
+        pixels.
+        """
+        lens = base.camLens
+        mat = self.nodepath.getMat(base.cam)
+        mat = np.array([[mat.getCell(i, j) for j in range(4)] for i in range(4)])
+        scale = np.sqrt(np.sum(mat[0,:3]**2))
+        x, y, z = (self.centers @ mat[:3,:3] + mat[3,:3]).T
+        radii = self.radii * scale
+        
+        fovh, fovv = np.deg2rad(lens.getFov()) / 2
+        near = lens.getNear()
+        visible = y > near - radii
+        for ax, fov in ((x, fovh), (z, fovv)):
+            visible &= ax * np.cos(fov) - y * np.sin(fov) <= radii
+            visible &= - ax * np.cos(fov) - y * np.sin(fov) <= radii
+        
+        dist = np.maximum(np.sqrt(x**2 + y**2 + z**2) - radii, near)
+        return visible, self.errors * scale * get_pointscale() / 2 / dist
+            
+    def update(self):
+        """Select the cells to draw and show them.
+        """
+        if len(self.chunks) == 0: return
+        visible, sse = self.get_visibility()
+        sizes = np.where(visible, self.sizes, 0)
+        
+        selected = set([0])
+        drawn = sizes[0]
+        heap = [(-sse[0], 0)]
+        while len(heap) > 0:
+            _, icell = heapq.heappop(heap)
+            ichildren = self.children[icell]
+            if len(ichildren) == 0 or not visible[icell] or sse[icell] <= self.maxerror:
+                continue
+            extra = np.sum(sizes[ichildren]) - sizes[icell]
+            if drawn + extra > self.budget: continue
+            drawn += extra
+            selected.remove(icell)
+            for ichild in ichildren:
+                selected.add(ichild)
+                heapq.heappush(heap, (-sse[ichild], ichild))
+
+        for icell in self.selected - selected:
+            self.chunks[icell].hide()
+        for icell in selected - self.selected:
+            self.chunks[icell].show()
+        self.selected = selected
+        self.drawn = int(drawn)
+
+#########################################################
+##### class MapAsset ####################################
+#########################################################
+
+ASSET_EXT = '.ovids3d'
+ASSET_VERSION = 1
+
+def write_map_asset(path, map3d, leafsize=100000, seed=0):
+    """Write a converted map: a directory holding the chunks of a
+    multi-resolution point cloud (see get_lod) as render-ready vertex
+    data, the octree, a colorbar image and the metadata of the map.
+    It can be loaded without any processing (see MapAsset).
+
+    :param path: path to the output directory (ASSET_EXT is appended if
+      needed)
+
+    :param map3d: a core.Map3d instance (colors computed on the CPU)
+
+    :param leafsize: maximum number of points in a chunk
+
+    :param seed: seed of the sampling of the inner cells
+
+    :return: the path to the output directory
+    """
+    if map3d.scalar:
+        raise Exception('maps colored on the GPU cannot be converted')
+    if not path.endswith(ASSET_EXT):
+        path += ASSET_EXT
+    os.makedirs(path, exist_ok=True)
+
+    xyz = (map3d.posx, map3d.posy, map3d.posz)
+    order, cells, samples, boxes = get_lod(xyz, leafsize, weights=map3d.colors, seed=seed)
+    offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([isample.size for isample in samples])
+    
+    vertices = np.lib.format.open_memmap(
+        os.path.join(path, 'vertices.npy'), mode='w+', dtype=V3C4_DTYPE,
+        shape=(int(offsets[-1]),))
+    rgba = map3d.points['rgba']
+    for icell, isample in enumerate(samples):
+        index = isample if order is None else order[isample]
+        ivertices = vertices[offsets[icell]:offsets[icell+1]]
+        for i in range(3):
+            ivertices['vertex'][:,i] = xyz[i][index]
+        if rgba.dtype == np.uint8:
+            ivertices['color'] = rgba[index]
+        else:
+            ivertices['color'] = np.clip(rgba[index] * 255, 0, 255).astype(np.uint8)
+    vertices.flush()
+    del vertices, samples
+
+    children = [ichildren for _, _, ichildren in cells]
+    np.savez(os.path.join(path, 'cells.npz'), offsets=offsets, boxes=boxes,
+             counts=np.array([stop - start for start, stop, _ in cells], dtype=np.int64),
+             children=np.array(sum(children, []), dtype=np.int64),
+             nchildren=np.array([len(ichildren) for ichildren in children], dtype=np.int64))
+
+    colorbar = dict(map3d.colorbar)
+    colorbar['cmap'] = getattr(colorbar['cmap'], 'name', colorbar['cmap'])
+    ovids3d.ext.cbar.make_colorbar(os.path.join(path, 'cbar.png'), **colorbar)
+    
+    meta = dict(version=ASSET_VERSION, total=int(map3d.posx.size), leafsize=leafsize,
+                seed=seed, scale=map3d.scale, colorbar=colorbar)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    logger.info('{} points converted into {} chunks ({})'.format(
+        meta['total'], len(cells), path))
+    return path
+
+class MapAsset(object):
+    """Map converted with write_map_asset (e.g. by the ovids3d-convert
+    script). The vertex data is memory-mapped.
+    """
+    
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != ASSET_VERSION:
+            raise Exception('{} was converted with another version, convert it again'.format(path))
+        self.path = path
+        self.total = meta['total']
+        self.scale = meta['scale']
+        self.colorbar = meta['colorbar']
+        self.cbar_path = os.path.join(path, 'cbar.png')
+        self.vertices = np.load(os.path.join(path, 'vertices.npy'), mmap_mode='r')
+        with np.load(os.path.join(path, 'cells.npz')) as cells:
+            self.offsets = cells['offsets']
+            self.boxes = cells['boxes']
+            self.counts = cells['counts']
+            edges = np.concatenate([[0], np.cumsum(cells['nchildren'])])
+            self.children = [cells['children'][edges[i]:edges[i+1]].tolist()
+                             for i in range(edges.size - 1)]
 
 #########################################################
 ##### class FarStars ####################################
@@ -36,37 +703,9 @@ class FarStars(core.DirectCore):
         return X/R, Y/R, Z/R
                 
     def add_stars(self, nb, color, intensity=1.):
-        # create vertices
-        format = GeomVertexFormat.getV3c4() # position and texcoord
-
-        vdata = GeomVertexData('vdata', format, Geom.UHStatic)
-
-        vwriter = GeomVertexWriter(vdata, 'vertex')
-        colorwriter = GeomVertexWriter(vdata, 'color')
-
-        # GeomPoints primitive
-        geompoints = GeomPoints(Geom.UHStatic)
-        
         posx, posy, posz = self.set_pos(nb)
-        
-        index = 0
-        for i in range(nb):
-            # random angle positions
-            vwriter.addData3f(posx[i], posy[i], posz[i])
-            
-            # random UVs
-            colorwriter.addData4f(1,1,1,1)
-
-            # add to GeomPoints
-            geompoints.addVertex(index)
-            geompoints.closePrimitive()
-            index += 1
-
-        # create GeomNode and put it in NodePath
-        geom = Geom(vdata)
-        geom.addPrimitive(geompoints)
-        gnode = GeomNode('starfield')
-        gnode.addGeom(geom)
+        rgba = [np.full(np.size(posx), 255, dtype=np.uint8)] * 4
+        gnode = make_points('starfield', (posx, posy, posz), rgba)
         nodepath = NodePath(gnode)
         nodepath.setRenderModePerspective(self.PERSPECTIVE)
         nodepath.setRenderModeThickness(self.PIXELSIZE)
@@ -100,93 +739,513 @@ class NearStars(FarStars):
 
 class Pixels(core.DirectCore):
 
-    def __init__(self, objects_node, map3d, cubescale=1., ascubes=False, alpha=1):
+    def __init__(self, objects_node, map3d, cubescale=1., ascubes=False, alpha=1,
+                 leafsize=100000, budget=None, scale=1., start=True):
+        """
+        :param map3d: a core.Map3d or a MapAsset instance
+
+        :param scale: scale applied to the positions of a MapAsset
+
+        :param leafsize: maximum number of points in a chunk (see
+          make_chunked_points)
+
+        :param budget: if not None, the map is drawn with a level of
+          detail depending on the distance (see PointLOD) and at most
+          budget points are drawn. It must be at least leafsize.
+
+        :param start: if False, the per-frame updates are not
+          registered in the scheduler until start() is called (by the
+          main thread, e.g. when the pixels are built by a worker
+          thread).
+        """
         super().__init__()
         
         self.cubescale = cubescale
+        self.leafsize = leafsize
+        self.budget = budget
+        self.leaves = None
+        self.lod = None
         self.node = objects_node.attachNewNode('pixels')
         self.alpha = alpha
         self.map3d = map3d
             
-        if ascubes:
+        if isinstance(map3d, MapAsset):
+            self.add_asset(map3d, scale=scale)
+        elif ascubes:
             self.add_cubes(*self.map3d.xyzrgba)
         else:
             self.add_pixels(*self.map3d.xyzrgba)
+        if start:
+            self.start()
+
+    def start(self):
+        """Register the per-frame updates in the scheduler. Must be
+        called by the main thread.
+        """
+        if self.lod is not None:
+            scheduler = core.get_scheduler()
+            scheduler.add(self.lodTask, 'pixels-lodTask-{}'.format(id(self)),
+                          priority=scheduler.VIEW)
     
     def add_cubes(self, posx, posy, posz, r, g, b, a):
-        model_path = core.ROOT + "/models/cube.x"
-
-        logger.info('creating map model')
-        logger.info('> you can skip this step by giving an already computed bam file instead of a fits file (see documentation)')
-        for i in range(posx.size):
-            if not i%100:
-                sys.stdout.write('{}/{}\r'.format(i, posx.size))
-        
-            model = loader.loadModel(model_path, noCache=False)
-            model.setPos(posx[i], posy[i], posz[i])
-            model.setColor(r[i], g[i], b[i], a[i] * self.alpha)
-            model.reparentTo(self.node)
-            model.setLightOff()
-            model.setScale(0.002 * self.cubescale)
-            sys.stdout.flush()
-
-        logger.info('clearing nodes')
-        self.node.clear_model_nodes()
-        logger.info('flattening nodes (this can take a long time)')
-        self.node.flattenStrong()
+        a = np.asarray(a)
+        if self.alpha != 1:
+            if a.dtype == np.uint8:
+                a = (a * self.alpha).clip(0, 255).astype(np.uint8)
+            else:
+                a = a * self.alpha
+                
+        model = loader.loadModel(core.ROOT + "/models/cube.x", noCache=False)
+        model.flattenStrong()
+        cube = model.find('**/+GeomNode').node()
         
-    def add_pixels(self, posx, posy, posz, r, g, b, a):
+        self.nodepath, self.leaves = make_chunked_cubes(
+            'cubes', cube, (posx, posy, posz), (r, g, b, a), 0.002 * self.cubescale,
+            leafsize=self.leafsize)
+        logger.info('number of cubes rendered: {}'.format(np.size(posx)))
 
+        self.nodepath.reparentTo(self.node)
+        self.nodepath.setLightOff()
+        self.nodepath.setTransparency(True)
         
-        # create vertices
-        format = GeomVertexFormat.getV3c4() # position and texcoord
+    def add_pixels(self, posx, posy, posz, r, g, b, a):
 
-        vdata = GeomVertexData('vdata', format, Geom.UHStatic)
+        a = np.asarray(a)
+        if self.alpha != 1:
+            if a.dtype == np.uint8:
+                a = (a * self.alpha).clip(0, 255).astype(np.uint8)
+            else:
+                a = a * self.alpha
+        if self.budget is not None:
+            self.lod = PointLOD('starfield', (posx, posy, posz), rgba=(r, g, b, a),
+                                weights=self.map3d.colors, leafsize=self.leafsize,
+                                budget=self.budget)
+            self._add_lod()
+        else:
+            node, self.leaves = make_chunked_points(
+                'starfield', (posx, posy, posz), rgba=(r, g, b, a), leafsize=self.leafsize)
+            self.nodepath = NodePath(node)
+            self._set_points_attribs()
+        logger.info('number of pixels rendered: {}'.format(np.size(posx)))
+
+    def add_asset(self, asset, scale=1.):
+        """Add a converted map (see MapAsset). It is always drawn with
+        a level of detail. If no budget is set, the chunks are refined
+        until their screen-space error is small enough.
+        """
+        budget = asset.total if self.budget is None else self.budget
+        self.lod = PointLOD.from_asset('starfield', asset, scale=scale, budget=budget)
+        self._add_lod()
+        if self.alpha != 1:
+            self.nodepath.setAlphaScale(self.alpha)
+        logger.info('number of pixels rendered: {}'.format(asset.total))
+
+    def _add_lod(self):
+        self.nodepath = self.lod.nodepath
+        self._set_points_attribs()
+        
+    def _set_points_attribs(self):
+        self.nodepath.setRenderModePerspective(True)
+        self.nodepath.setRenderModeThickness(3.8)
+        
+        self.nodepath.reparentTo(self.node)
+        self.nodepath.setLightOff()
+        self.nodepath.setShaderAuto()
+        self.nodepath.setTransparency(True)
+        self.nodepath.setBin('background', 0)
+        
+    def get_drawn_count(self):
+        """Return (drawn, total): the number of points in the camera
+        frustum and the total number of points. Chunks out of the
+        frustum are culled.
+        """
+        if self.lod is not None:
+            return self.lod.drawn, self.lod.total
+        return count_drawn_points(self.nodepath, self.leaves), self.map3d.posx.size
+
+    def lodTask(self, task):
+        self.lod.update()
+        return task.cont
+        
+    def destroy(self):
+        core.get_scheduler().remove('pixels-lodTask-{}'.format(id(self)))
+        self.node.removeNode()
 
-        vwriter = GeomVertexWriter(vdata, 'vertex')
-        colorwriter = GeomVertexWriter(vdata, 'color')
 
-        # GeomPoints primitive
-        geompoints = GeomPoints(Geom.UHStatic)
+#########################################################
+##### class ScalarPixels ################################
+#########################################################
 
-        index = 0
-        for i in range(posx.size):
-            # random angle positions
-            vwriter.addData3f(posx[i], posy[i], posz[i])
-            
-            # random UVs
-            colorwriter.addData4f(r[i], g[i], b[i], a[i] * self.alpha)
+class ScalarPixels(core.DirectCore):
+    """Point cloud colored on the GPU. Each vertex only stores its
+    flux, the colormap is a texture and the flux limits, colorpower
+    and colorscale are shader inputs: they can all be changed at any
+    time without touching the geometry.
 
-            # add to GeomPoints
-            geompoints.addVertex(index)
-            geompoints.closePrimitive()
-            index += 1
+    :param map3d: a core.Map3d instance created with scalar=True
+    """
+    
+    THICKNESS = 3.8
+    
+    def __init__(self, objects_node, map3d, alpha=1, leafsize=100000, budget=None,
+                 start=True):
+        """
+        :param leafsize: maximum number of points in a chunk
 
-        logger.info('number of pixels rendered: {}'.format(index))
+        :param budget: maximum number of points drawn (see Pixels)
 
-        # create GeomNode and put it in NodePath
-        geom = Geom(vdata)
-        geom.addPrimitive(geompoints)
-        gnode = GeomNode('starfield')
-        gnode.addGeom(geom)
-        self.nodepath = NodePath(gnode)
+        :param start: see Pixels
+        """
+        super().__init__()
+        if not map3d.scalar: raise Exception('map3d must be created with scalar=True')
         
-        self.nodepath.setRenderModePerspective(True)
-        self.nodepath.setRenderModeThickness(3.8)
+        self.node = objects_node.attachNewNode('pixels')
+        self.alpha = alpha
+        self.map3d = map3d
+
+        xyz = (map3d.posx, map3d.posy, map3d.posz)
+        if budget is not None:
+            self.lod = PointLOD('starfield', xyz, scalars=map3d.colors,
+                                weights=map3d.colors - map3d.vmin, leafsize=leafsize,
+                                budget=budget, thickness=self.THICKNESS)
+            self.nodepath = self.lod.nodepath
+        else:
+            self.lod = None
+            node, self.leaves = make_chunked_points(
+                'starfield', xyz, scalars=map3d.colors, leafsize=leafsize)
+            self.nodepath = NodePath(node)
+        logger.info('number of pixels rendered: {}'.format(map3d.posx.size))
         
         self.nodepath.reparentTo(self.node)
         self.nodepath.setLightOff()
-        self.nodepath.setShaderAuto()
         self.nodepath.setTransparency(True)
         self.nodepath.setBin('background', 0)
         
+        shader = Shader.load(Shader.SL_GLSL,
+                             vertex=core.ROOT + '/shaders/scalar.vert',
+                             fragment=core.ROOT + '/shaders/scalar.frag')
+        self.nodepath.setShader(shader)
+        self.nodepath.setAttrib(self.nodepath.getAttrib(ShaderAttrib).setFlag(
+            ShaderAttrib.F_shader_point_size, True))
+        self.nodepath.setShaderInput('thickness', self.THICKNESS)
+        self.nodepath.setShaderInput('pointscale', 1.)
+        
+        self.set_cmap(map3d.cmap)
+        self.set_limits(map3d.vmin, map3d.vmax)
+        self.set_colorpower(map3d.colorpower)
+        self.set_colorscale(map3d.colorscale)
+        if start:
+            self.start()
+
+    def start(self):
+        """Register the per-frame updates in the scheduler. Must be
+        called by the main thread.
+        """
+        scheduler = core.get_scheduler()
+        scheduler.add(self.pointscaleTask, 'pixels-pointscaleTask-{}'.format(id(self)),
+                      priority=scheduler.VIEW)
+        
+    def pointscaleTask(self, task):
+        # same perspective point size as Panda3D's fixed-function pipeline
+        self.nodepath.setShaderInput('pointscale', get_pointscale())
+        if self.lod is not None:
+            self.lod.update()
+        return task.cont
+        
+    def set_cmap(self, cmap):
+        self.cmap = cmap
+        self.nodepath.setShaderInput('cmap', make_cmap_texture(cmap))
+        
+    def set_limits(self, vmin, vmax):
+        self.vmin, self.vmax = float(vmin), float(vmax)
+        self.nodepath.setShaderInput('vmin', self.vmin)
+        self.nodepath.setShaderInput('vmax', self.vmax)
+        
+    def set_perc(self, perc):
+        """Set the flux limits from percentiles, computed on the flux
+        histogram of the map.
+        """
+        self.perc = tuple(perc)
+        self.set_limits(*self.map3d.quantiles.get(perc))
+        
+    def set_colorpower(self, colorpower):
+        self.colorpower = float(colorpower)
+        self.nodepath.setShaderInput('colorpower', self.colorpower)
+
+    def set_colorscale(self, colorscale):
+        self.colorscale = tuple(colorscale)
+        colorscale = Vec4(*self.colorscale)
+        colorscale[3] *= self.alpha
+        self.nodepath.setShaderInput('colorscale', colorscale)
+
+    def get_drawn_count(self):
+        """Return (drawn, total) (see Pixels.get_drawn_count)
+        """
+        if self.lod is not None:
+            return self.lod.drawn, self.map3d.posx.size
+        return count_drawn_points(self.nodepath, self.leaves), self.map3d.posx.size
         
     def destroy(self):
-        for m in self.nodepath.getChildren():
-            m.destroy()
-        self.nodepath.removeNode()
+        core.get_scheduler().remove('pixels-pointscaleTask-{}'.format(id(self)))
+        self.node.removeNode()
+
 
+#########################################################
+##### class LayerPixels #################################
+#########################################################
+
+class LayerPixels(core.DirectCore):
+    """Point cloud holding several maps (layers) with the same
+    positions, colored on the GPU (see shaders/layers.vert). The
+    positions are uploaded once and the flux of each layer is a
+    separate vertex array: adding a layer only uploads this column.
+    Each layer has its own colormap, flux limits, colorpower,
+    colorscale and weight. Layers are added with their weight: they
+    can be shown, hidden, blended and cross-faded at any time.
 
+    Layers can be given by index or by name.
+
+    :param map3d: first layer, a core.Map3d instance created with
+      scalar=True and keepnan=True.
+    """
+    
+    THICKNESS = 3.8
+    MAXLAYERS = 8
+    CMAPSIZE = 256
+    
+    def __init__(self, objects_node, map3d, name=None, alpha=1, leafsize=100000,
+                 threads=None):
+        super().__init__()
+        if not (map3d.scalar and map3d.keepnan):
+            raise Exception('map3d must be created with scalar=True and keepnan=True')
+        
+        self.node = objects_node.attachNewNode('pixels')
+        self.alpha = alpha
+        self.map3d = map3d
+        self.threads = threads
+        self.layers = list()
+        self.maps = list()
+        
+        xyz = (map3d.posx, map3d.posy, map3d.posz)
+        self.order, self.leaves = get_octree_leaves(xyz, leafsize)
+        vformat = self.get_format(0)
+        assert vformat.getArray(0).getStride() == 12, 'unexpected vertex format'
+        
+        def build(ileaf):
+            index = self._get_leaf_index(ileaf)
+            nb = self.leaves[ileaf][1] - self.leaves[ileaf][0]
+            vdata = GeomVertexData('vdata', vformat, Geom.UHStatic)
+            vdata.uncleanSetNumRows(nb)
+            buf = np.frombuffer(memoryview(vdata.modifyArray(0)).cast('B'),
+                                dtype=np.float32).reshape((nb, 3))
+            for i in range(3):
+                buf[:,i] = xyz[i][index]
+            del buf
+            gnode = _make_points_node('starfield-{}'.format(ileaf), vdata, nb)
+            gnode.setBoundsType(BoundingVolume.BT_box)
+            return gnode
+
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            self.gnodes = list(executor.map(build, range(len(self.leaves))))
+        
+        self.nodepath = NodePath(PandaNode('starfield'))
+        for gnode in self.gnodes:
+            self.nodepath.attachNewNode(gnode)
+        logger.info('number of pixels rendered: {}'.format(map3d.posx.size))
+        
+        self.nodepath.reparentTo(self.node)
+        self.nodepath.setLightOff()
+        self.nodepath.setTransparency(True)
+        self.nodepath.setBin('background', 0)
+
+        shader = Shader.load(Shader.SL_GLSL,
+                             vertex=core.ROOT + '/shaders/layers.vert',
+                             fragment=core.ROOT + '/shaders/layers.frag')
+        self.nodepath.setShader(shader)
+        self.nodepath.setAttrib(self.nodepath.getAttrib(ShaderAttrib).setFlag(
+            ShaderAttrib.F_shader_point_size, True))
+        self.nodepath.setShaderInput('thickness', self.THICKNESS)
+        self.nodepath.setShaderInput('pointscale', 1.)
+
+        # uniform arrays: updated in place
+        self.params_values = np.zeros((self.MAXLAYERS, 4), dtype=np.float32)
+        self.params = PTA_LVecBase4f.emptyArray(self.MAXLAYERS)
+        self.colorscales = PTA_LVecBase4f.emptyArray(self.MAXLAYERS)
+        self.nodepath.setShaderInput('params', self.params)
+        self.nodepath.setShaderInput('colorscales', self.colorscales)
+        
+        self.cmaps = np.zeros((self.MAXLAYERS, self.CMAPSIZE, 4), dtype=np.uint8)
+        self.cmaps_tex = Texture('cmaps')
+        self.cmaps_tex.setup2dTexture(self.CMAPSIZE, self.MAXLAYERS,
+                                      Texture.T_unsigned_byte, Texture.F_rgba8)
+        self.cmaps_tex.setWrapU(SamplerState.WM_clamp)
+        self.cmaps_tex.setWrapV(SamplerState.WM_clamp)
+        # rows are sampled at their center: no blending between layers
+        self.cmaps_tex.setMinfilter(SamplerState.FT_linear)
+        self.cmaps_tex.setMagfilter(SamplerState.FT_linear)
+        self.nodepath.setShaderInput('cmaps', self.cmaps_tex)
+        
+        self.add_layer(map3d, name=name)
+        
+        scheduler = core.get_scheduler()
+        scheduler.add(self.pointscaleTask, 'pixels-pointscaleTask-{}'.format(id(self)),
+                      priority=scheduler.VIEW)
+
+    def _get_leaf_index(self, ileaf):
+        start, stop = self.leaves[ileaf]
+        if self.order is None:
+            return slice(start, stop)
+        return self.order[start:stop]
+        
+    def get_format(self, nlayers):
+        """Return the vertex format of a cloud with nlayers layers:
+        float32 positions, then one array per layer with a single
+        float32 column (layer0, layer1, ...).
+        """
+        array = GeomVertexArrayFormat()
+        array.addColumn(InternalName.make('vertex'), 3, Geom.NT_float32, Geom.C_point)
+        vformat = GeomVertexFormat()
+        vformat.addArray(array)
+        for i in range(nlayers):
+            array = GeomVertexArrayFormat()
+            array.addColumn(InternalName.make('layer{}'.format(i)), 1,
+                            Geom.NT_float32, Geom.C_other)
+            vformat.addArray(array)
+        return GeomVertexFormat.registerFormat(vformat)
+        
+    def add_layer(self, map3d, name=None):
+        """Add a layer. Only its flux column is uploaded.
+
+        :param map3d: a core.Map3d instance created with scalar=True
+          and keepnan=True from a file with the same positions as the
+          first layer.
+
+        :param name: name of the layer (default is 'layer<index>')
+
+        :return: the index of the layer
+        """
+        if len(self.layers) >= self.MAXLAYERS:
+            raise Exception('the maximum number of layers is {}'.format(self.MAXLAYERS))
+        if map3d is not self.map3d:
+            if not (map3d.scalar and map3d.keepnan):
+                raise Exception('map3d must be created with scalar=True and keepnan=True')
+            for ax in ('posx', 'posy', 'posz'):
+                if not np.array_equal(getattr(map3d, ax), getattr(self.map3d, ax)):
+                    raise Exception('the positions of the layer are not the same as the positions of the first layer')
+        ilayer = len(self.layers)
+        if name is None:
+            name = 'layer{}'.format(ilayer)
+        if name in self.layers:
+            raise Exception('layer {} already exists'.format(name))
+        
+        vformat = self.get_format(ilayer + 1)
+        arrayformat = vformat.getArray(ilayer + 1)
+        
+        def build(ileaf):
+            array = GeomVertexArrayData(arrayformat, Geom.UHStatic)
+            array.uncleanSetNumRows(self.leaves[ileaf][1] - self.leaves[ileaf][0])
+            np.frombuffer(memoryview(array).cast('B'), dtype=np.float32)[:] = map3d.colors[
+                self._get_leaf_index(ileaf)]
+            return array
+        
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+            arrays = list(executor.map(build, range(len(self.leaves))))
+
+        # the arrays of the previous layers are shared, not copied
+        for gnode, array in zip(self.gnodes, arrays):
+            geom = gnode.modifyGeom(0)
+            old_vdata = geom.getVertexData()
+            vdata = GeomVertexData(old_vdata.getName(), vformat, Geom.UHStatic)
+            for i in range(old_vdata.getNumArrays()):
+                vdata.setArray(i, old_vdata.getArray(i))
+            vdata.setArray(ilayer + 1, array)
+            geom.setVertexData(vdata)
+
+        self.layers.append(name)
+        self.maps.append(map3d)
+        self.set_cmap(ilayer, map3d.cmap)
+        self.set_limits(ilayer, map3d.vmin, map3d.vmax)
+        self.set_colorpower(ilayer, map3d.colorpower)
+        self.set_colorscale(ilayer, map3d.colorscale)
+        self.set_weight(ilayer, 1)
+        logger.info('layer {} added'.format(name))
+        return ilayer
+
+    def get_layer(self, layer):
+        """Return the index of a layer given by index or name.
+        """
+        if isinstance(layer, str):
+            if layer not in self.layers:
+                raise Exception('unknown layer {} (layers: {})'.format(layer, self.layers))
+            return self.layers.index(layer)
+        layer = int(layer)
+        if not 0 <= layer < len(self.layers):
+            raise Exception('bad layer index {}'.format(layer))
+        return layer
+    
+    def pointscaleTask(self, task):
+        self.nodepath.setShaderInput('pointscale', get_pointscale())
+        return task.cont
+
+    def _set_param(self, layer, i, value):
+        self.params_values[layer,i] = value
+        self.params[layer] = Vec4(*self.params_values[layer])
+        
+    def set_cmap(self, layer, cmap):
+        layer = self.get_layer(layer)
+        self.cmaps[layer] = core.ColorLUT(cmap, size=self.CMAPSIZE).rgba8
+        self.cmaps_tex.setRamImageAs(self.cmaps.tobytes(), 'RGBA')
+        
+    def set_limits(self, layer, vmin, vmax):
+        layer = self.get_layer(layer)
+        self._set_param(layer, 0, float(vmin))
+        self._set_param(layer, 1, float(vmax))
+        
+    def set_perc(self, layer, perc):
+        """Set the flux limits of a layer from percentiles (see
+        ScalarPixels.set_perc).
+        """
+        layer = self.get_layer(layer)
+        self.set_limits(layer, *self.maps[layer].quantiles.get(perc))
+        
+    def set_colorpower(self, layer, colorpower):
+        self._set_param(self.get_layer(layer), 2, float(colorpower))
+
+    def set_colorscale(self, layer, colorscale):
+        colorscale = Vec4(*colorscale)
+        colorscale[3] *= self.alpha
+        self.colorscales[self.get_layer(layer)] = colorscale
+        
+    def set_weight(self, layer, weight):
+        """Set the weight of a layer in the sum of the layers (0
+        hides it).
+        """
+        self._set_param(self.get_layer(layer), 3, float(weight))
+
+    def get_weight(self, layer):
+        return float(self.params_values[self.get_layer(layer),3])
+        
+    def show_layer(self, layer):
+        self.set_weight(layer, 1)
+
+    def hide_layer(self, layer):
+        self.set_weight(layer, 0)
+
+    def crossfade(self, layer0, layer1, t):
+        """Cross-fade from layer0 (t=0) to layer1 (t=1).
+        """
+        t = min(max(float(t), 0), 1)
+        self.set_weight(layer0, 1 - t)
+        self.set_weight(layer1, t)
+        
+    def get_drawn_count(self):
+        """Return (drawn, total) (see Pixels.get_drawn_count)
+        """
+        return count_drawn_points(self.nodepath, self.leaves), self.map3d.posx.size
+        
+    def destroy(self):
+        core.get_scheduler().remove('pixels-pointscaleTask-{}'.format(id(self)))
+        self.node.removeNode()
 
 
 #########################################################
@@ -377,7 +1436,9 @@ class Background(core.DirectCore):
         # pitch = up down (confirmed)
         # heading = rotation (confirmed)
         # roll = left right (confirmed)
-        taskMgr.add(self.sphereTask, "Sphere Task")
+        scheduler = core.get_scheduler()
+        scheduler.add(self.sphereTask, 'background-sphereTask-{}'.format(id(self)),
+                      priority=scheduler.VIEW)
         
     def sphereTask(self, task):
         self.sphere.setPos(base.camera, 0, 0, 0)
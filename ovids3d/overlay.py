@@ -2,6 +2,9 @@ from direct.gui.DirectGui import OnscreenText, OnscreenImage, DirectEntry
 from direct.showbase.DirectObject import DirectObject
 from panda3d.core import TextNode, Vec3
 from . import core
+from . import models
+from . import cache
+import ovids3d.ext.cbar
 import os
 import numpy as np
 import io
@@ -39,7 +42,8 @@ class Overlay(DirectObject):
         self.monofont = loader.loadFont(
             core.ROOT + '/fonts/fantasque-sans-mono/TTF/FantasqueSansMono-Bold.ttf')
 
-        self.title = ''
+        self.cbar = (None, None)
+        self.colorbar_items = list()
 
         self.visor = None
         self.terminalin = None
@@ -71,10 +75,25 @@ class Overlay(DirectObject):
                 image=core.ROOT + '/textures/licence.png', pos=(1.69, 0, -0.95), scale=0.1)
         licence.setTransparency(True)
         licence.setColorScale((1,1,1,0.8))
-        
 
-        taskMgr.remove('overlay-update')
-        taskMgr.add(self.update, 'overlay-update')
+        # the text nodes are created once and their text is only
+        # changed when it differs (see set_text)
+        self.title_text = OnscreenText(
+            text='', parent=self.base.a2dBottomRight, align=TextNode.A_right,
+            style=2, fg=(1, 1, 1, 1), pos=(-0.1, 0.1), scale=.07, mayChange=True)
+        self.coords_text = OnscreenText(
+            text='', parent=self.base.a2dTopLeft, align=TextNode.A_left,
+            style=3, fg=(1, 1, 1, 1), pos=(0.1, -0.1), scale=.05, mayChange=True)
+        self.terminalout_text = None
+        if self.config.full_overlay:
+            self.terminalout_text = OnscreenText(
+                text='', parent=self.base.a2dBottomLeft, align=TextNode.A_left,
+                font=self.monofont, style=3, fg=(1, 1, 1, 1), pos=(0.1, +0.15),
+                scale=.03, mayChange=True)
+
+        scheduler = core.get_scheduler()
+        scheduler.add(self.update, 'overlay-update', priority=scheduler.HUD,
+                      rate=self.config['hud_rate'])
     
     def terminalCommand(self, text):
         self.terminalout.write('[eval({})]'.format(text))
@@ -89,63 +108,81 @@ class Overlay(DirectObject):
     def terminalFocusOut(self):
         self.keysmgr.disabled = False
         
+    def update_colorbar(self):
+        """Redraw the colorbar when it has changed. A colorbar is given
+        either by its parameters (config['cbar'], see
+        core.Map3d.colorbar), or as an image (config['cbar_path']).
+        """
+        cbar = (self.config.get('cbar', None), self.config.get('cbar_path', None))
+        if cbar == self.cbar: return
+        self.cbar = cbar
+        for item in self.colorbar_items:
+            item.destroy()
+        self.colorbar_items = list()
+        
+        spec, cbar_path = cbar
+        if spec is not None and self.config.get('cbar_png', False):
+            cache_dir = self.config.get('cache_dir', None)
+            if cache_dir is None:
+                cache_dir = cache.CACHE_DIR
+            cbar_path = ovids3d.ext.cbar.get_colorbar_path(cache_dir, **spec)
+            spec = None
+            
+        if spec is not None:
+            # gradient texture built in memory and text labels
+            bar = OnscreenImage(
+                image=models.make_cmap_texture(spec['cmap'], colorpower=spec['colorpower'],
+                                               vertical=True),
+                pos=(-1.25, 0, 0), scale=(0.025, 1, 0.45))
+            self.colorbar_items.append(bar)
+            for level in np.linspace(0, 1, 5):
+                value = spec['vmin'] + level * (spec['vmax'] - spec['vmin'])
+                self.colorbar_items.append(OnscreenText(
+                    text='{:.3g}'.format(value), align=TextNode.A_left,
+                    style=3, fg=(1, 1, 1, 1), pos=(-1.21, -0.46 + 0.9 * level), scale=.035))
+            self.colorbar_items.append(OnscreenText(
+                text=str(spec['unit']), style=3, fg=(1, 1, 1, 1), pos=(-1.25, 0.5), scale=.04))
+            
+        elif cbar_path is not None:
+            image = OnscreenImage(image=cbar_path, pos=(-1.3, 0, 0), scale=0.5)
+            image.setTransparency(True)
+            self.colorbar_items.append(image)
+            
+    def set_text(self, item, text):
+        """Change the text of an OnscreenText only if it differs from
+        the displayed one (a new text is laid out again).
+        """
+        if item.getText() == text: return
+        item.setText(text)
+            
     def update(self, task):
 
-        title = self.config.get('title', 'Ovids3d')
-        if title != self.title:
-            self.title = title
-            try:
-                self.title_text.destroy()
-            except AttributeError: pass
-    
-            self.title_text = OnscreenText(
-                text=title,
-                parent=self.base.a2dBottomRight, align=TextNode.A_right,
-                style=2, fg=(1, 1, 1, 1), pos=(-0.1, 0.1), scale=.07)
+        self.set_text(self.title_text, self.config.get('title', 'Ovids3d'))
 
         if self.config.full_overlay:
-            cbar_path = self.config.get('cbar_path', None)
-            if cbar_path is not None:
-                if not hasattr(self, 'colorbar'):
-                    self.colorbar = OnscreenImage(
-                        image=cbar_path, pos=(-1.3, 0, 0), scale=0.5)
-                    self.colorbar.setTransparency(True)
-            else:
-                try:
-                    self.colorbar.destroy()
-                except Exception as e: pass
+            self.update_colorbar()
             
-        try:
-            self.coords_text.destroy()
-        except AttributeError: pass
-
         text = "distance to {} (in {}): {:.3f}".format(
             str(self.config.get('center_name', 'center')),
             str(self.config.get('space_unit', 'space unit')),
             float(self.config.get('distance', 'nan')))
         
+        loading = self.config.get('loading', None)
+        if loading is not None:
+            text += "\n loading {}".format(loading)
+        
         if self.config.full_overlay:
             text += "\n > Cartesian: {:.1f} {:.1f} {:.1f}".format(*self.config.get('pos_xyz', (np.nan, np.nan, np.nan)))
             text += "\n > Spherical: {:.1f} {:.1f} {:.1f}".format(*self.config.get('pos_sph', (np.nan, np.nan, np.nan)))
             text += "\n > HPR: {:.1f} {:.1f} {:.1f}".format(*self.config.get('pos_hpr', (np.nan, np.nan, np.nan)))
+            if 'points_drawn' in self.config:
+                text += "\n > Points: {} drawn, {} culled".format(
+                    self.config['points_drawn'], self.config['points_culled'])
 
-        self.coords_text = OnscreenText(
-            text=text,
-            parent=self.base.a2dTopLeft,
-            align=TextNode.A_left,
-            style=3, fg=(1, 1, 1, 1), pos=(0.1, -0.1), scale=.05)
+        self.set_text(self.coords_text, text)
 
         if self.config.full_overlay:
-            try:
-                self.terminalout_text.destroy()
-            except AttributeError: pass
-
-            self.terminalout_text = OnscreenText(
-                text=self.terminalout.get_out(),
-                parent=self.base.a2dBottomLeft,
-                align=TextNode.A_left,
-                font=self.monofont,
-                style=3, fg=(1, 1, 1, 1), pos=(0.1, +0.15), scale=.03)
+            self.set_text(self.terminalout_text, self.terminalout.get_out())
         
         return task.cont
 
@@ -0,0 +1,659 @@
+import os
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+def _get_image(image):
+    # return a 2D array from an array or the path to a FITS image
+    # (memory-mapped)
+    if isinstance(image, str):
+        import astropy.io.fits as pyfits
+        image = pyfits.open(image, memmap=True)[0].data
+    if np.ndim(image) != 2: raise Exception('Bad image shape - Should be 2D')
+    return image
+
+#########################################################
+##### class Reader ######################################
+#########################################################
+
+class Reader(object):
+    """Chunked access to a list of N points (x, y, z, flux), read by
+    core.Map3d. The input is opened (and preprocessed if needed) by
+    open(), so that nothing is read when the processed map is found in
+    the cache.
+    """
+
+    def __init__(self):
+        self.size = None
+        # files read, keying the cache (the map is not cached if empty)
+        self.paths = list()
+        # parameters of the reader, keying the cache
+        self.params = dict()
+
+    def __str__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(self.paths))
+
+    def open(self):
+        """Open the input and set the number of points (self.size).
+        """
+        raise NotImplementedError()
+
+    def get_chunk(self, start, stop):
+        """Return a float32 (4, n) array of the points [start:stop]: x,
+        y, z and flux.
+        """
+        raise NotImplementedError()
+
+#########################################################
+##### class FitsImageReader #############################
+#########################################################
+
+class FitsImageReader(Reader):
+    """Reader of a FITS image HDU holding an (N, 4) or (4, N) array of
+    (X, Y, Z, F) values.
+    """
+
+    def __init__(self, path, memmap=False, hdu=0):
+        """
+        :param memmap: if True, the HDU is memory-mapped and only read
+          chunk by chunk.
+
+        :param hdu: index of the image HDU (e.g. 1 for a tile-compressed
+          file)
+        """
+        super().__init__()
+        self.paths = [path]
+        self.memmap = memmap
+        self.hdu = hdu
+        if hdu != 0:
+            self.params['hdu'] = hdu
+
+    def open(self):
+        import astropy.io.fits as pyfits
+        hdu = pyfits.open(self.paths[0], memmap=self.memmap)[self.hdu]
+        data = hdu.data
+        if not self.memmap:
+            data = np.asarray(data)
+
+        logger.info('data shape: {}'.format(data.shape))
+        if data.ndim != 2: raise Exception('Bad data shape - Should be (N, 4)')
+        if 4 not in data.shape: raise Exception('Bad data shape - Should be (N, 4)')
+        self.data = data
+        self.transposed = (data.shape[1] == 4)
+        self.size = data.shape[0] if self.transposed else data.shape[1]
+
+    def get_chunk(self, start, stop):
+        if self.transposed:
+            return np.array(self.data[start:stop], dtype=np.float32).T
+        else:
+            return np.array(self.data[:,start:stop], dtype=np.float32)
+
+#########################################################
+##### class MapsReader ##################################
+#########################################################
+
+class MapsReader(Reader):
+    """Reader of the pixels of 2D flux and velocity maps (e.g. SITELLE
+    products): x and y are the pixel coordinates, z is the velocity.
+    Only the pixels brighter than a threshold are kept. The maps are
+    read by blocks of rows and can be memory-mapped: only the indices
+    of the kept pixels are held in memory.
+
+    The default scales are not the ones of the quick-start guide
+    (docs/quick_start.md): x and y are scaled by half the size of the
+    frame and the velocity is recentred on its median (see __init__).
+    """
+
+    def __init__(self, flux, velocity, fluxperc=90, threshold=None, center=None,
+                 xyscale=None, vcenter=None, vscale=None, chunksize=1000000):
+        """
+        :param flux: 2D flux map, or path to a FITS image
+
+        :param velocity: 2D velocity map, or path to a FITS image
+
+        :param fluxperc: percentile of the flux (of the valid pixels)
+          used as threshold. It is computed on a regular sample of at
+          most chunksize pixels.
+
+        :param threshold: flux threshold, used instead of fluxperc
+
+        :param center: (x, y) pixel position of the origin (default is
+          the center of the frame)
+
+        :param xyscale: size of one unit in pixels (default is half the
+          largest dimension of the frame)
+
+        :param vcenter: velocity of the origin (default is the median
+          velocity of the kept pixels)
+
+        :param vscale: velocity of one unit (default is the 95th
+          percentile of the absolute velocity of the kept pixels,
+          relative to vcenter)
+
+        :param chunksize: number of pixels read at once
+        """
+        super().__init__()
+        self.flux = flux
+        self.velocity = velocity
+        if isinstance(flux, str) and isinstance(velocity, str):
+            self.paths = [flux, velocity]
+        self.params = dict(reader='maps', fluxperc=fluxperc, threshold=threshold,
+                           center=center, xyscale=xyscale, vcenter=vcenter,
+                           vscale=vscale)
+        self.chunksize = int(chunksize)
+
+    def __str__(self):
+        if len(self.paths) > 0:
+            return super().__str__()
+        return 'MapsReader({} maps)'.format(np.shape(self.flux))
+
+    def open(self):
+        flux = _get_image(self.flux)
+        velocity = _get_image(self.velocity)
+        if flux.shape != velocity.shape:
+            raise Exception('flux and velocity maps must have the same shape')
+        ny, nx = flux.shape
+        rows = max(1, self.chunksize // nx)
+        params = self.params
+
+        threshold = params['threshold']
+        if threshold is None:
+            # regular sample of the pixels (see CubeReader)
+            step = max(1, int(np.ceil(np.sqrt(ny * nx / self.chunksize))))
+            values = np.asarray(flux[::step,::step], dtype=np.float32).ravel()
+            values = values[np.isfinite(values)]
+            if values.size == 0: raise Exception('no valid pixel in the flux map')
+            threshold = np.percentile(values, params['fluxperc'])
+            del values
+        logger.info('flux threshold: {}'.format(threshold))
+
+        index = list()
+        for y in range(0, ny, rows):
+            iflux = np.asarray(flux[y:y+rows], dtype=np.float32)
+            ivel = np.asarray(velocity[y:y+rows], dtype=np.float32)
+            with np.errstate(invalid='ignore'):
+                iok = (iflux > threshold) & np.isfinite(ivel)
+            index.append(np.flatnonzero(iok) + y * nx)
+        self.index = np.concatenate(index)
+        self.size = self.index.size
+        logger.info('{} pixels kept out of {}'.format(self.size, flux.size))
+
+        # flat views on the maps (no copy for C-contiguous and
+        # memory-mapped maps)
+        self.flat_flux = np.ravel(flux)
+        self.flat_velocity = np.ravel(velocity)
+        self.shape = flux.shape
+
+        self.center = params['center']
+        if self.center is None:
+            self.center = (nx / 2., ny / 2.)
+        self.xyscale = params['xyscale']
+        if self.xyscale is None:
+            self.xyscale = max(nx, ny) / 2.
+
+        self.vcenter, self.vscale = params['vcenter'], params['vscale']
+        if self.vcenter is None or self.vscale is None:
+            vel = np.empty(self.size, dtype=np.float32)
+            for start in range(0, self.size, self.chunksize):
+                vel[start:start+self.chunksize] = self.flat_velocity[
+                    self.index[start:start+self.chunksize]]
+            if self.vcenter is None:
+                self.vcenter = float(np.median(vel)) if self.size > 0 else 0.
+            if self.vscale is None:
+                vel -= self.vcenter
+                self.vscale = float(np.percentile(np.abs(vel), 95)) if self.size > 0 else 1.
+                if self.vscale == 0: self.vscale = 1.
+            del vel
+        logger.info('velocity center and scale: {} {}'.format(self.vcenter, self.vscale))
+
+    def get_chunk(self, start, stop):
+        index = self.index[start:stop]
+        y, x = np.divmod(index, self.shape[1])
+        chunk = np.empty((4, index.size), dtype=np.float32)
+        chunk[0] = (x - self.center[0]) / self.xyscale
+        chunk[1] = (y - self.center[1]) / self.xyscale
+        chunk[2] = (self.flat_velocity[index] - self.vcenter) / self.vscale
+        chunk[3] = self.flat_flux[index]
+        return chunk
+
+#########################################################
+##### class CubeReader ##################################
+#########################################################
+
+class CubeReader(Reader):
+    """Reader of the voxels of a 3D spectral cube (e.g. a SITELLE
+    cube): x and y are the pixel coordinates and z is the velocity of
+    the channel. Only the voxels brighter than a threshold are kept.
+    The cube can be memory-mapped and is walked channel by channel:
+    only one channel (and the indices of its kept voxels) is held in
+    memory at a time.
+    """
+
+    C = 299792.458 # speed of light in km/s
+
+    def __init__(self, cube, restwl, spectral=None, axis='wavelength', channels=None,
+                 fluxperc=99, threshold=None, center=None, xyscale=None, vcenter=None,
+                 vscale=None, chunksize=1000000):
+        """
+        :param cube: (nchannels, ny, nx) cube, or path to a FITS cube
+
+        :param restwl: rest wavelength (or wavenumber) of the line, in
+          the unit of the spectral axis
+
+        :param spectral: wavelength (or wavenumber) of each channel. If
+          None, it is read from the FITS header (CRVAL3, CDELT3 or
+          CD3_3, CRPIX3).
+
+        :param axis: 'wavelength' or 'wavenumber' (e.g. SITELLE cubes
+          in cm-1)
+
+        :param channels: (start, stop) range of the channels read
+          (default is all the channels), e.g. around the line
+
+        :param fluxperc: percentile of the flux used as threshold. It
+          is computed on a regular sample of at most chunksize voxels.
+
+        :param threshold: flux threshold, used instead of fluxperc
+
+        :param center: (x, y) pixel position of the origin (default is
+          the center of the frame)
+
+        :param xyscale: size of one unit in pixels (default is half the
+          largest dimension of the frame)
+
+        :param vcenter: velocity of the origin in km/s (default is the
+          center of the velocity range)
+
+        :param vscale: velocity of one unit in km/s (default is half
+          the velocity range)
+
+        :param chunksize: number of voxels read at once
+        """
+        super().__init__()
+        if axis not in ('wavelength', 'wavenumber'):
+            raise Exception("axis must be 'wavelength' or 'wavenumber'")
+        self.cube = cube
+        if isinstance(cube, str):
+            self.paths = [cube]
+        if spectral is not None:
+            spectral = [float(s) for s in spectral]
+        self.params = dict(reader='cube', restwl=restwl, spectral=spectral, axis=axis,
+                           channels=channels, fluxperc=fluxperc, threshold=threshold,
+                           center=center, xyscale=xyscale, vcenter=vcenter, vscale=vscale)
+        self.chunksize = int(chunksize)
+
+    def __str__(self):
+        if len(self.paths) > 0:
+            return super().__str__()
+        return 'CubeReader({} cube)'.format(np.shape(self.cube))
+
+    def _get_cube(self):
+        # return (cube, spectral axis)
+        params = self.params
+        cube = self.cube
+        spectral = params['spectral']
+        if isinstance(cube, str):
+            import astropy.io.fits as pyfits
+            hdu = pyfits.open(cube, memmap=True)[0]
+            cube = hdu.data
+            if spectral is None:
+                header = hdu.header
+                step = header.get('CDELT3', header.get('CD3_3', None))
+                if 'CRVAL3' not in header or step is None:
+                    raise Exception('the spectral axis must be given (no CRVAL3, CDELT3 in the header)')
+                spectral = header['CRVAL3'] + step * (
+                    np.arange(cube.shape[0]) + 1 - header.get('CRPIX3', 1))
+        if np.ndim(cube) != 3: raise Exception('Bad cube shape - Should be 3D')
+        if spectral is None: raise Exception('the spectral axis must be given')
+        spectral = np.asarray(spectral, dtype=float)
+        if spectral.size != cube.shape[0]:
+            raise Exception('the spectral axis must have one value per channel')
+        return cube, spectral
+
+    def open(self):
+        cube, spectral = self._get_cube()
+        params = self.params
+        nz, ny, nx = cube.shape
+        first, last = (0, nz) if params['channels'] is None else params['channels']
+        self.cube_data = cube
+        self.channels = np.arange(max(first, 0), min(last, nz))
+        self.shape = (ny, nx)
+
+        # radial velocity of each channel
+        if params['axis'] == 'wavelength':
+            ratio = spectral / params['restwl']
+        else:
+            ratio = params['restwl'] / spectral
+        self.velocities = self.C * (ratio[self.channels] - 1)
+        
+        threshold = params['threshold']
+        if threshold is None:
+            # regular sample of the voxels, read channel by channel
+            step = max(1, int(np.ceil(np.sqrt(
+                self.channels.size * ny * nx / self.chunksize))))
+            values = list()
+            for ichannel in self.channels:
+                ivalues = np.asarray(cube[ichannel,::step,::step], dtype=np.float32).ravel()
+                values.append(ivalues[np.isfinite(ivalues)])
+            values = np.concatenate(values)
+            if values.size == 0: raise Exception('no valid voxel in the cube')
+            threshold = np.percentile(values, params['fluxperc'])
+            del values
+        self.threshold = threshold
+        logger.info('flux threshold: {}'.format(threshold))
+
+        # first pass: number of kept voxels in each channel
+        counts = np.empty(self.channels.size, dtype=np.int64)
+        for i, ichannel in enumerate(self.channels):
+            counts[i] = self._read_channel(ichannel)[0].size
+        self.edges = np.concatenate([[0], np.cumsum(counts)])
+        self.size = int(self.edges[-1])
+        self._channel = (None, None)
+        logger.info('{} voxels kept out of {}'.format(self.size, self.channels.size * ny * nx))
+
+        self.center = params['center']
+        if self.center is None:
+            self.center = (nx / 2., ny / 2.)
+        self.xyscale = params['xyscale']
+        if self.xyscale is None:
+            self.xyscale = max(nx, ny) / 2.
+        vrange = (np.min(self.velocities), np.max(self.velocities))
+        self.vcenter = params['vcenter']
+        if self.vcenter is None:
+            self.vcenter = (vrange[0] + vrange[1]) / 2.
+        self.vscale = params['vscale']
+        if self.vscale is None:
+            self.vscale = (vrange[1] - vrange[0]) / 2. or 1.
+        logger.info('velocity center and scale: {} {}'.format(self.vcenter, self.vscale))
+
+    def _read_channel(self, ichannel):
+        # return the flat indices of the kept voxels of a channel and
+        # their flux
+        iflux = np.asarray(self.cube_data[ichannel], dtype=np.float32).ravel()
+        with np.errstate(invalid='ignore'):
+            index = np.flatnonzero(iflux > self.threshold)
+        return index, iflux[index]
+
+    def _get_channel(self, i):
+        # the last channel read is kept since consecutive chunks
+        # often share a channel
+        if self._channel[0] != i:
+            self._channel = (i, self._read_channel(self.channels[i]))
+        return self._channel[1]
+
+    def get_chunk(self, start, stop):
+        chunk = np.empty((4, stop - start), dtype=np.float32)
+        first = np.searchsorted(self.edges, start, side='right') - 1
+        last = np.searchsorted(self.edges, stop, side='left')
+        for i in range(first, last):
+            index, flux = self._get_channel(i)
+            istart = max(start, self.edges[i])
+            istop = min(stop, self.edges[i+1])
+            if istop <= istart: continue
+            isl = slice(istart - self.edges[i], istop - self.edges[i])
+            csl = slice(istart - start, istop - start)
+            y, x = np.divmod(index[isl], self.shape[1])
+            chunk[0,csl] = (x - self.center[0]) / self.xyscale
+            chunk[1,csl] = (y - self.center[1]) / self.xyscale
+            chunk[2,csl] = (self.velocities[i] - self.vcenter) / self.vscale
+            chunk[3,csl] = flux[isl]
+        return chunk
+
+#########################################################
+##### columnar readers ##################################
+#########################################################
+
+class ColumnReader(Reader):
+    """Base class of the readers of tables: the points are read from
+    the 4 columns named by the user (x, y, z and flux). The other
+    columns are never read. Subclasses implement open() and
+    read_column().
+    """
+
+    def __init__(self, path, columns=None):
+        """
+        :param columns: names of the x, y, z and flux columns (default
+          is ('x', 'y', 'z', 'flux'))
+        """
+        super().__init__()
+        if columns is None:
+            columns = ('x', 'y', 'z', 'flux')
+        if len(columns) != 4:
+            raise Exception('4 column names must be given (x, y, z, flux)')
+        self.paths = [path]
+        self.columns = tuple(columns)
+        self.params = dict(reader=self.__class__.__name__, columns=list(self.columns))
+
+    def read_column(self, column, start, stop):
+        """Return the values [start:stop] of a column.
+        """
+        raise NotImplementedError()
+
+    def get_chunk(self, start, stop):
+        chunk = np.empty((4, stop - start), dtype=np.float32)
+        for i, column in enumerate(self.columns):
+            chunk[i] = self.read_column(column, start, stop)
+        return chunk
+
+class NpyReader(ColumnReader):
+    """Reader of a .npy file (memory-mapped) holding a structured
+    array, or an (N, 4) or (4, N) array of (X, Y, Z, F) values (the
+    column names are then ignored).
+    """
+
+    def open(self):
+        self.data = np.load(self.paths[0], mmap_mode='r')
+        if self.data.dtype.names is not None:
+            for column in self.columns:
+                if column not in self.data.dtype.names:
+                    raise Exception('column {} not found in {}'.format(column, self.paths[0]))
+            self.size = self.data.shape[0]
+            self.transposed = None
+        else:
+            if self.data.ndim != 2 or 4 not in self.data.shape:
+                raise Exception('Bad data shape - Should be (N, 4) or a structured array')
+            self.transposed = (self.data.shape[1] == 4)
+            self.size = self.data.shape[0] if self.transposed else self.data.shape[1]
+
+    def read_column(self, column, start, stop):
+        if self.transposed is None:
+            return self.data[column][start:stop]
+        i = self.columns.index(column)
+        if self.transposed:
+            return self.data[start:stop,i]
+        return self.data[i,start:stop]
+
+class NpzReader(ColumnReader):
+    """Reader of a .npz file holding one array per column. Only the 4
+    columns are loaded.
+    """
+
+    def open(self):
+        with np.load(self.paths[0]) as npz:
+            for column in self.columns:
+                if column not in npz.files:
+                    raise Exception('column {} not found in {}'.format(column, self.paths[0]))
+            self.data = {column: npz[column] for column in set(self.columns)}
+        self.size = self.data[self.columns[0]].size
+
+    def read_column(self, column, start, stop):
+        return self.data[column][start:stop]
+
+class HDF5Reader(ColumnReader):
+    """Reader of an HDF5 file (requires h5py). The columns are either
+    datasets (e.g. 'x' or 'catalog/x') or the fields of a compound
+    dataset.
+    """
+
+    def __init__(self, path, columns=None, dataset=None):
+        """
+        :param dataset: name of a compound dataset holding the columns
+          as fields. If None, each column is a dataset.
+        """
+        super().__init__(path, columns=columns)
+        self.dataset = dataset
+        self.params['dataset'] = dataset
+
+    def open(self):
+        try:
+            import h5py
+        except ImportError:
+            raise Exception('h5py is required to read HDF5 files')
+        self.file = h5py.File(self.paths[0], 'r')
+        if self.dataset is not None:
+            dataset = self.file[self.dataset]
+            self.data = {column: dataset.fields(column) for column in self.columns}
+            self.size = dataset.shape[0]
+        else:
+            self.data = {column: self.file[column] for column in self.columns}
+            self.size = self.data[self.columns[0]].shape[0]
+
+    def read_column(self, column, start, stop):
+        return self.data[column][start:stop]
+
+class ParquetReader(ColumnReader):
+    """Reader of a Parquet file (requires pyarrow). Only the 4 columns
+    of the row groups spanned by a chunk are read.
+    """
+
+    def open(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception('pyarrow is required to read Parquet files')
+        self.file = pyarrow.parquet.ParquetFile(self.paths[0])
+        metadata = self.file.metadata
+        self.edges = np.concatenate([[0], np.cumsum(
+            [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])])
+        self.size = int(self.edges[-1])
+        self._group = (None, None)
+
+    def _get_group(self, i):
+        # the last row group read is kept since consecutive chunks
+        # often share a row group
+        if self._group[0] != i:
+            table = self.file.read_row_group(i, columns=list(set(self.columns)))
+            self._group = (i, {column: table.column(column).to_numpy()
+                               for column in set(self.columns)})
+        return self._group[1]
+
+    def get_chunk(self, start, stop):
+        chunk = np.empty((4, stop - start), dtype=np.float32)
+        first = np.searchsorted(self.edges, start, side='right') - 1
+        last = np.searchsorted(self.edges, stop, side='left')
+        for i in range(first, last):
+            group = self._get_group(i)
+            istart = max(start, self.edges[i])
+            istop = min(stop, self.edges[i+1])
+            if istop <= istart: continue
+            for j, column in enumerate(self.columns):
+                chunk[j,istart-start:istop-start] = group[column][
+                    istart - self.edges[i]:istop - self.edges[i]]
+        return chunk
+
+class BinTableReader(ColumnReader):
+    """Reader of a FITS binary table (memory-mapped).
+    """
+
+    def __init__(self, path, columns=None, hdu=None):
+        """
+        :param hdu: index or name of the table HDU (default is the first
+          table)
+        """
+        super().__init__(path, columns=columns)
+        self.hdu = hdu
+        self.params['hdu'] = hdu
+
+    def open(self):
+        import astropy.io.fits as pyfits
+        hdulist = pyfits.open(self.paths[0], memmap=True)
+        if self.hdu is None:
+            tables = [ihdu for ihdu in hdulist if isinstance(ihdu, pyfits.BinTableHDU)]
+            if len(tables) == 0: raise Exception('no binary table in {}'.format(self.paths[0]))
+            hdu = tables[0]
+        else:
+            hdu = hdulist[self.hdu]
+        self.data = hdu.data
+        self.size = len(self.data)
+
+    def read_column(self, column, start, stop):
+        return self.data.field(column)[start:stop]
+
+#########################################################
+##### readers registry ##################################
+#########################################################
+
+READERS = dict()
+
+def register_reader(extensions, reader):
+    """Register a reader class for a list of file extensions (see
+    get_reader). The class is built as reader(path, columns=columns,
+    **kwargs).
+    """
+    for ext in extensions:
+        READERS[ext.lower()] = reader
+
+def _is_fits(path):
+    # True if path is a FITS file (possibly compressed), whatever its
+    # extension
+    import astropy.io.fits as pyfits
+    try:
+        pyfits.getheader(path, 0)
+    except Exception:
+        return False
+    return True
+
+def _get_image_hdu(path):
+    # index of the first image HDU holding data in a FITS file, or None
+    import astropy.io.fits as pyfits
+    with pyfits.open(path) as hdulist:
+        for i, hdu in enumerate(hdulist):
+            if hdu.is_image and hdu.header.get('NAXIS', 0) != 0:
+                return i
+    return None
+
+def get_reader_class(path):
+    """Return the reader class registered for the extension of a file,
+    or None. A file with an unknown extension (e.g. .fz or none) is
+    read as a FITS file if it is one.
+    """
+    lpath = path.lower()
+    for ext in sorted(READERS, key=len, reverse=True):
+        if lpath.endswith(ext):
+            return READERS[ext]
+    if os.path.isfile(path) and _is_fits(path):
+        return FitsImageReader
+    return None
+
+def get_reader(path, columns=None, memmap=False, **kwargs):
+    """Return a reader of a file, chosen from its extension (see
+    get_reader_class). A FITS file is read as an (N, 4) image from its
+    first image HDU holding data, or as a binary table if columns are
+    given or if it has no such HDU.
+
+    :param columns: names of the x, y, z and flux columns of a table
+
+    :param memmap: if True, a FITS image is memory-mapped (see
+      FitsImageReader). The other inputs are always read by chunks.
+
+    :param kwargs: other parameters of the reader (e.g. dataset for an
+      HDF5 file)
+    """
+    reader = get_reader_class(path)
+    if reader is None:
+        raise Exception('no reader for {} (known extensions: {})'.format(
+            path, ', '.join(sorted(READERS))))
+    if reader is FitsImageReader:
+        if columns is None:
+            hdu = _get_image_hdu(path)
+            if hdu is not None:
+                return FitsImageReader(path, memmap=memmap, hdu=hdu)
+        reader = BinTableReader
+    return reader(path, columns=columns, **kwargs)
+
+register_reader(('.fits', '.fit', '.fits.gz', '.fts'), FitsImageReader)
+register_reader(('.npy',), NpyReader)
+register_reader(('.npz',), NpzReader)
+register_reader(('.h5', '.hdf5', '.hdf'), HDF5Reader)
+register_reader(('.parquet', '.pq'), ParquetReader)
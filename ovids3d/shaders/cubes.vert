@@ -0,0 +1,21 @@
+#version 150
+
+// Instanced cubes: one cube mesh drawn once per pixel. The position
+// and the color of each instance are read from a buffer texture
+// holding 2 texels per instance: (x, y, z, 1) and (r, g, b, a).
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform vec4 p3d_ColorScale;
+
+uniform samplerBuffer instances;
+uniform float cubesize;
+
+in vec4 p3d_Vertex;
+
+out vec4 color;
+
+void main() {
+  vec4 pos = texelFetch(instances, gl_InstanceID * 2);
+  color = texelFetch(instances, gl_InstanceID * 2 + 1) * p3d_ColorScale;
+  gl_Position = p3d_ModelViewProjectionMatrix * vec4(p3d_Vertex.xyz * cubesize + pos.xyz, 1.0);
+}
@@ -0,0 +1,56 @@
+#version 150
+
+// Multi-layer point cloud: the vertices hold one flux column per
+// layer (layer0 to layer7). Each layer is mapped to a color through
+// its own row of the colormap texture and the layers are added with
+// their weight. A layer whose weight is 0 is hidden.
+
+#define MAXLAYERS 8
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+uniform sampler2D cmaps; // one row per layer
+uniform vec4 params[MAXLAYERS]; // vmin, vmax, colorpower, weight
+uniform vec4 colorscales[MAXLAYERS];
+uniform float thickness; // point size in 3d units
+uniform float pointscale; // screen height / tan(vertical fov / 2) in pixels, as Panda3D does
+
+in vec4 p3d_Vertex;
+in float layer0;
+in float layer1;
+in float layer2;
+in float layer3;
+in float layer4;
+in float layer5;
+in float layer6;
+in float layer7;
+
+out vec4 color;
+
+void main() {
+  gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+
+  float values[MAXLAYERS] = float[](layer0, layer1, layer2, layer3,
+                                    layer4, layer5, layer6, layer7);
+  color = vec4(0.0);
+  for (int i = 0; i < MAXLAYERS; i++) {
+    if (params[i].w <= 0.0) continue;
+    // vmax <= vmin is a step at vmin
+    float level = (values[i] - params[i].x) / max(params[i].y - params[i].x, 1e-30);
+    if (!(level >= 0.0)) continue; // also rejects nans
+    level = pow(min(level, 1.0), params[i].z);
+    color += params[i].w * colorscales[i] * vec4(
+      texture(cmaps, vec2(level, (float(i) + 0.5) / float(MAXLAYERS))).rgb, 1.0);
+  }
+  
+  if (color.a <= 0.0) {
+    // out of the clip volume: never rasterized
+    gl_Position = vec4(0.0, 0.0, 2.0, 1.0);
+    gl_PointSize = 0.0;
+    return;
+  }
+  color.a = min(color.a, 1.0);
+
+  // perspective point size
+  gl_PointSize = thickness * pointscale / gl_Position.w;
+}
@@ -0,0 +1,38 @@
+#version 150
+
+// Point cloud colored on the GPU: each vertex only holds its flux
+// (scalar), mapped to a color through a colormap texture.
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+uniform sampler2D cmap;
+uniform float vmin;
+uniform float vmax;
+uniform float colorpower;
+uniform vec4 colorscale;
+uniform float thickness; // point size in 3d units
+uniform float pointscale; // screen height / tan(vertical fov / 2) in pixels, as Panda3D does
+
+in vec4 p3d_Vertex;
+in float scalar;
+
+out vec4 color;
+
+void main() {
+  gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+
+  // vmax <= vmin is a step at vmin
+  float level = (scalar - vmin) / max(vmax - vmin, 1e-30);
+  if (level < 0.0) {
+    // out of the clip volume: never rasterized
+    gl_Position = vec4(0.0, 0.0, 2.0, 1.0);
+    gl_PointSize = 0.0;
+    color = vec4(0.0);
+    return;
+  }
+  level = pow(min(level, 1.0), colorpower);
+  color = vec4(texture(cmap, vec2(level, 0.5)).rgb, 1.0) * colorscale;
+
+  // perspective point size
+  gl_PointSize = thickness * pointscale / gl_Position.w;
+}
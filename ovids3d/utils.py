@@ -1,6 +1,5 @@
+import sys
 import numpy as np
-import astropy.coordinates
-from astropy import units as u
 
 def xyz2sph(x, y, z):
     r = np.sqrt(x**2 + y**2 + z**2)
@@ -17,6 +16,52 @@ def sph2xyz(r, theta, phi):
     return x, y, z
 
 
+def _spread_bits(q):
+    # insert two zeros between each of the 21 lower bits of q (uint64)
+    q &= np.uint64(0x1fffff)
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff),
+                        (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)):
+        q |= q << np.uint64(shift)
+        q &= np.uint64(mask)
+    return q
+
+def morton_codes(x, y, z, bits=21, bounds=None):
+    """Return the Morton (Z-order) codes of a set of points as a uint64
+    array. Sorting the points by their codes gives a spatially coherent
+    order: the points of any cell of the octree spanning the bounds
+    have contiguous codes.
+
+    :param x, y, z: coordinates of the points
+
+    :param bits: number of bits per axis (max 21)
+
+    :param bounds: (min, max) of the coordinates on all the axes. If
+      None, computed from the finite coordinates.
+
+    Non-finite coordinates get the code of the lower bound.
+    """
+    assert 0 < bits <= 21, 'bits must be between 1 and 21'
+    if bounds is None:
+        xyz = np.concatenate([np.ravel(ax) for ax in (x, y, z)])
+        xyz = xyz[np.isfinite(xyz)]
+        bounds = (np.min(xyz), np.max(xyz)) if xyz.size > 0 else (0, 0)
+    lo, hi = float(bounds[0]), float(bounds[1])
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        lo, hi = 0., 0.
+    factor = (2**bits - 1) / max(hi - lo, float(np.finfo(np.float32).tiny))
+    
+    codes = np.zeros(np.size(x), dtype=np.uint64)
+    for i, ax in enumerate((x, y, z)):
+        q = np.asarray(ax, dtype=np.float64) - lo
+        q *= factor
+        q[~np.isfinite(q)] = 0
+        np.clip(q, 0, 2**bits - 1, out=q)
+        q = _spread_bits(q.astype(np.uint64))
+        q <<= np.uint64(2 - i) # x is the most significant bit
+        codes |= q
+    return codes
+
 def to_lbd(coords):
     return np.array((coords.galactic.l.value,
                      coords.galactic.b.value,
@@ -32,7 +77,9 @@ def compute_milky_way_hpr(ra, dec):
     """
     DIFF = 5e-6
     DIST = 1 # object distance in kpc (unnecessary)
-    
+
+    import astropy.coordinates
+    from astropy import units as u
 
     origin_coords = astropy.coordinates.SkyCoord(
         ra=ra*u.degree, dec=dec*u.degree, distance=DIST*u.kpc)
@@ -49,3 +96,35 @@ def compute_milky_way_hpr(ra, dec):
     print(heading, pitch, roll)
     return heading, pitch, roll
 
+
+def reset_peak_memory():
+    """Reset the peak resident memory counter of the current process
+    (Linux only, silently ignored elsewhere).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (OSError, IOError):
+        pass
+
+def get_peak_memory():
+    """Return the peak resident memory of the current process in MB
+    (since the last call to reset_peak_memory() on Linux). Return None
+    if it cannot be measured on this platform.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return float(line.split()[1]) / 1024.
+    except (OSError, IOError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes on macOS, kB elsewhere
+        peak /= 1024.
+    return peak / 1024.
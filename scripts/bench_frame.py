@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+# Author: Thomas Martin <thomas.martin.1@ulaval.ca>
+# File: bench_frame.py
+
+"""Benchmark of the per-frame Python overhead of the engine: a World
+is rendered offscreen for a number of frames and the average time
+spent in each task (other than the tasks of Panda3D itself, e.g. the
+rendering) is reported, as well as the time per frame of each job of
+the scheduler of the engine (e.g. the overlay).
+"""
+
+import time
+import argparse
+
+from panda3d.core import loadPrcFileData
+
+# tasks of Panda3D (ShowBase) not counted in the overhead
+PANDA_TASKS = ('resetPrevTransform', 'dataLoop', 'eventManager', 'ivalLoop',
+               'collisionLoop', 'garbageCollectStates', 'igLoop', 'audioLoop',
+               'manager-update')
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the per-frame Python overhead of the engine")
+    parser.add_argument('--frames', type=int, default=600, help="number of frames")
+    parser.add_argument('--path', default=None, help="map to load (optional)")
+    parser.add_argument('--full', action='store_true', default=False,
+                        help="full overlay")
+    parser.add_argument('--hud-rate', type=float, default=None,
+                        help="refresh rate of the overlay in Hz (default is config['hud_rate'])")
+    args = parser.parse_args()
+
+    loadPrcFileData('', 'window-type offscreen\nwin-size 800 600\nsync-video false\n'
+                    'audio-library-name null')
+    from ovids3d.engine import World
+    from ovids3d import core
+
+    kwargs = dict()
+    if args.hud_rate is not None:
+        kwargs['hud_rate'] = args.hud_rate
+    w = World(full_overlay=args.full, **kwargs)
+    if args.path is not None:
+        w.add_map(args.path, 'hot')
+
+    # time spent in each job of the scheduler
+    jobtimes = dict()
+    def timed(job):
+        func = job.func
+        jobtimes[job.name] = 0.
+        def run(task):
+            start = time.perf_counter()
+            result = func(task)
+            jobtimes[job.name] += time.perf_counter() - start
+            return result
+        return run
+    for job in core.get_scheduler().jobs:
+        job.func = timed(job)
+
+    # the camera flies forward
+    w.ship.keysmgr.keys['w'] = True
+    for i in range(args.frames):
+        w.base.taskMgr.step()
+
+    total = 0
+    for task in sorted(w.base.taskMgr.mgr.getActiveTasks(), key=lambda t: -t.getAverageDt()):
+        if task.name in PANDA_TASKS: continue
+        print('{:<40} {:8.1f} us'.format(task.name, task.getAverageDt() * 1e6))
+        total += task.getAverageDt()
+    print('{:<40} {:8.1f} us'.format('total Python overhead per frame', total * 1e6))
+
+    print('scheduler jobs (time per frame):')
+    for name, jobtime in sorted(jobtimes.items(), key=lambda item: -item[1]):
+        print('  {:<38} {:8.1f} us'.format(name, jobtime / args.frames * 1e6))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+# Author: Thomas Martin <thomas.martin.1@ulaval.ca>
+# File: bench_points.py
+
+"""Benchmark of the point cloud geometry construction: per-vertex
+GeomVertexWriter loop (former Pixels.add_pixels) vs bulk numpy upload
+(models.make_points). No window is needed.
+"""
+
+import time
+import argparse
+import numpy as np
+
+from panda3d.core import GeomVertexFormat, GeomVertexData, Geom, GeomPoints, GeomVertexWriter, GeomNode
+
+import ovids3d.models
+
+def make_points_loop(xyz, rgba):
+    vdata = GeomVertexData('vdata', GeomVertexFormat.getV3c4(), Geom.UHStatic)
+    vwriter = GeomVertexWriter(vdata, 'vertex')
+    colorwriter = GeomVertexWriter(vdata, 'color')
+    geompoints = GeomPoints(Geom.UHStatic)
+    for i in range(xyz.shape[1]):
+        vwriter.addData3f(xyz[0,i], xyz[1,i], xyz[2,i])
+        colorwriter.addData4f(rgba[0,i], rgba[1,i], rgba[2,i], rgba[3,i])
+        geompoints.addVertex(i)
+        geompoints.closePrimitive()
+    geom = Geom(vdata)
+    geom.addPrimitive(geompoints)
+    gnode = GeomNode('starfield')
+    gnode.addGeom(geom)
+    return gnode
+
+def bench(func, *args):
+    stime = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - stime
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the point cloud geometry construction")
+    parser.add_argument('--nb', type=int, default=1000000, help="number of points")
+    parser.add_argument('--noloop', action='store_true', default=False,
+                        help="skip the (slow) per-vertex loop")
+    args = parser.parse_args()
+
+    xyz = np.random.standard_normal((3, args.nb)).astype(np.float32)
+    rgba = np.random.uniform(size=(4, args.nb)).astype(np.float32)
+
+    if not args.noloop:
+        t = bench(make_points_loop, xyz, rgba)
+        print('per-vertex loop: {:.2f} s, {:.3g} points/s'.format(t, args.nb / t))
+    t = bench(ovids3d.models.make_points, 'starfield', xyz, rgba)
+    print('bulk upload: {:.2f} s, {:.3g} points/s'.format(t, args.nb / t))
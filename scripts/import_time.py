@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+# Author: Thomas Martin <thomas.martin.1@ulaval.ca>
+# File: import_time.py
+
+"""Import-time report of the ovids3d package. The import is run in a
+fresh interpreter with python -X importtime; the total time and the
+most expensive modules are printed. With --budget, the script exits
+with a non-zero status when the import is slower than the budget, so
+that a regression (e.g. a heavy dependency imported at module level)
+can be caught.
+"""
+
+import sys
+import argparse
+import subprocess
+
+def get_import_times(module):
+    """Return a list of (cumulative time in s, self time in s, module
+    name, depth) for each module imported by ``import module``.
+    """
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True).stderr
+
+    times = list()
+    for iline in out.splitlines():
+        if not iline.startswith('import time:'): continue
+        iself, icumul, iname = iline[len('import time:'):].split('|')
+        try:
+            iself, icumul = int(iself) / 1e6, int(icumul) / 1e6
+        except ValueError: # header
+            continue
+        depth = (len(iname) - len(iname.lstrip())) // 2
+        times.append((icumul, iself, iname.strip(), depth))
+    return times
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Import-time report of the ovids3d package")
+    parser.add_argument('--module', default='ovids3d.engine',
+                        help="module to import (default ovids3d.engine)")
+    parser.add_argument('--top', type=int, default=15,
+                        help="number of modules reported")
+    parser.add_argument('--budget', type=float, default=None,
+                        help="maximum import time in s")
+    args = parser.parse_args()
+
+    times = get_import_times(args.module)
+    total = [itime[0] for itime in times if itime[2] == args.module][0]
+
+    print('import {}: {:.3f} s'.format(args.module, total))
+    print('{:>10} {:>10}  module'.format('cumul (s)', 'self (s)'))
+    for icumul, iself, iname, idepth in sorted(times, reverse=True)[:args.top]:
+        print('{:>10.3f} {:>10.3f}  {}{}'.format(icumul, iself, ' ' * idepth, iname))
+
+    if args.budget is not None and total > args.budget:
+        print('import time over budget ({:.3f} s > {:.3f} s)'.format(total, args.budget))
+        sys.exit(1)